@@ -1,44 +1,347 @@
+import html
 import json
+import sqlite3
 import streamlit as st
+from streamlit import runtime
 from pathlib import Path, PurePosixPath
-import random
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import threading
 import argparse
+import time
+import numpy as np
+from phoebe import data as catalogue
 
 NUMBER_QUESTIONS = 10
+AUDIO_CACHE_MAX_BYTES = 256 * 1024 * 1024
+RATING_LABELS = ["Presence", "Noise", "Multiple"]
 
 AUDIO_DIR = Path().resolve() / "audio" / "data" / "processed"
-APP_DATA_PATH = Path().resolve() / "audio" / "data" / "app_data.json"
 RATINGS_PATH = Path().resolve() / "ratings.json"
-BIRD_IMAGE_DATA_PATH = Path().resolve() / "images" / "data" / "bird_images.jsonl"
+RATINGS_DB_PATH = Path().resolve() / "ratings.db"
 BIRD_IMAGE_DIR = Path().resolve() / "images" / "data" / "birds"
+STATIC_MANIFEST_PATH = Path().resolve() / "audio" / "data" / "static_manifest.json"
+SIMILARITY_INDEX_PATH = Path().resolve() / "audio" / "data" / "similarity_index.npz"
+STATIC_URL = "/app/static"
+MAX_REDRAWS = 1000  # Redraws of a round's species or recordings before giving up on a catalogue too tight to sample
+
+
+class QuestionIndex:
+    """Recordings numbered consecutively by species, so that questions can be drawn in bulk as integer arrays"""
+    __slots__ = ("species_names", "recordings", "counts", "offsets", "odd_species", "paired_species", "similarity")
+
+    def __init__(self, recordings_by_species: dict, similarity: dict = None):
+        self.species_names = list(recordings_by_species)
+        self.recordings = [record for name in self.species_names for record in recordings_by_species[name]]
+        self.counts = np.array([len(recordings_by_species[name]) for name in self.species_names], dtype=np.int64)
+        self.offsets = np.cumsum(self.counts) - self.counts
+        # A paired bird needs two recordings and an odd bird one
+        self.odd_species = np.flatnonzero(self.counts >= 1)
+        self.paired_species = np.flatnonzero(self.counts >= 2)
+        # The similarity index built by audio/embeddings.py is only used if it numbers recordings as this index does
+        recording_ids = [record["recording_id"] for record in self.recordings]
+        if similarity is not None and similarity["recording_ids"].tolist() != recording_ids:
+            similarity = None
+        self.similarity = similarity
+
+    def sample_rounds(self, n_rounds: int, n_questions: int = NUMBER_QUESTIONS, seed=None, hard: bool = False) -> tuple:
+        """Draw rounds as recording ids, shaped (rounds, questions, 3), and the odd bird's position in each question
+
+        In hard rounds the odd bird is one of the species most alike the paired bird, and the recordings are those
+        most alike a randomly drawn recording of the paired bird.
+        """
+        if len(self.paired_species) < 1 or len(self.odd_species) < 2:
+            raise ValueError("Questions need one species with two recordings and another with at least one")
+        # A species is used at most twice a question, and a question needs a pair of one species and a third recording
+        usable = np.minimum(self.counts, 2 * n_questions)
+        if usable.sum() < 3 * n_questions or (usable // 2).sum() < n_questions:
+            raise ValueError(f"Too few recordings for {n_questions} questions without repeating a recording")
+        if hard and self.similarity is None:
+            raise ValueError("Hard questions need a similarity index for the app data")
+        rng = np.random.default_rng(seed)
+
+        # Draw species for the odd bird and the two paired birds, redrawing any round that uses a species more often
+        # than it has recordings
+        species = np.empty((n_rounds, 3 * n_questions), dtype=np.int64)
+        redraw = np.arange(n_rounds)
+        for _ in range(MAX_REDRAWS):
+            species[redraw] = self._draw_species(rng, (len(redraw), n_questions), hard).reshape(len(redraw), -1)
+            uses = occurrence_rank(species[redraw]) + 1
+            redraw = redraw[(uses > self.counts[species[redraw]]).any(axis=1)]
+            if not len(redraw):
+                break
+        else:
+            raise ValueError(f"Could not draw species for {n_questions} questions from the recordings of each species")
+
+        # Draw a recording of each species, then redraw any that repeat a recording earlier in the round
+        ids = self.offsets[species] + rng.integers(0, self.counts[species])
+        if hard:
+            self._draw_similar(rng, ids.reshape(n_rounds, n_questions, 3), species.reshape(n_rounds, n_questions, 3))
+        rows = np.arange(n_rounds)
+        for _ in range(MAX_REDRAWS):
+            repeated = occurrence_rank(ids[rows]) > 0
+            rows, repeated = rows[repeated.any(axis=1)], repeated[repeated.any(axis=1)]
+            if not len(rows):
+                break
+            redrawn, redrawn_species = ids[rows], species[rows][repeated]
+            redrawn[repeated] = self.offsets[redrawn_species] + rng.integers(0, self.counts[redrawn_species])
+            ids[rows] = redrawn
+        else:
+            raise ValueError(f"Could not draw {n_questions} questions without repeating a recording")
+        ids = ids.reshape(n_rounds, n_questions, 3)
+
+        # Shuffle the odd bird, which is drawn first, in among the paired birds
+        order = np.argsort(rng.random(ids.shape), axis=-1)
+        return np.take_along_axis(ids, order, axis=-1), np.argmax(order == 0, axis=-1)
+
+    def _draw_species(self, rng: np.random.Generator, shape: tuple, hard: bool = False) -> np.ndarray:
+        """Draw a paired species and a different odd species for each question, as (odd, paired, paired)"""
+        paired = self.paired_species[rng.integers(len(self.paired_species), size=shape)]
+        if hard:
+            neighbours = self.similarity["neighbours"]
+            odd = neighbours[paired, rng.integers(neighbours.shape[1], size=shape)]
+            return np.stack([odd, paired, paired], axis=-1)
+        # Draw the odd species from the others by skipping over the paired species' position
+        skip = np.searchsorted(self.odd_species, paired)
+        k = rng.integers(len(self.odd_species) - 1, size=shape)
+        odd = self.odd_species[k + (k >= skip)]
+        return np.stack([odd, paired, paired], axis=-1)
+
+    def _draw_similar(self, rng: np.random.Generator, ids: np.ndarray, species: np.ndarray) -> None:
+        """Replace the odd bird and second paired bird of each question with recordings alike the first paired bird"""
+        # Each recording's nearest recordings are looked up in the index, so this costs a few gathers per question
+        neighbours = self.similarity["neighbours"]
+        similar_recordings = self.similarity["similar_recordings"]
+        same_species = self.similarity["same_species"]
+        anchor = ids[..., 1]
+        position = np.argmax(neighbours[species[..., 1]] == species[..., 0, None], axis=-1)
+        ids[..., 0] = similar_recordings[anchor, position, rng.integers(similar_recordings.shape[2], size=anchor.shape)]
+        ids[..., 2] = same_species[anchor, rng.integers(same_species.shape[1], size=anchor.shape)]
+
+
+def occurrence_rank(values: np.ndarray) -> np.ndarray:
+    """Count, for each element of a 2-D array, the earlier elements of its row having the same value"""
+    order = np.argsort(values, axis=1, kind="stable")
+    sorted_values = np.take_along_axis(values, order, axis=1)
+    position = np.broadcast_to(np.arange(values.shape[1]), values.shape)
+    new_group = np.ones(values.shape, dtype=bool)
+    new_group[:, 1:] = sorted_values[:, 1:] != sorted_values[:, :-1]
+    group_start = np.maximum.accumulate(np.where(new_group, position, 0), axis=1)
+    rank = np.empty_like(values)
+    np.put_along_axis(rank, order, position - group_start, axis=1)
+    return rank
+
+
+# The catalogue, question index and audio cache are loaded when a game starts rather than on import, so the start page
+# is shown without waiting for them
+@st.cache_resource
+def load_question_index():
+    return QuestionIndex(catalogue.load().records, similarity=load_similarity_index())
+
+
+def load_similarity_index():
+    """Arrays of the similarity index built by audio/embeddings.py, or None if it has not been built"""
+    if not SIMILARITY_INDEX_PATH.exists():
+        return None
+    with np.load(SIMILARITY_INDEX_PATH) as index:
+        return {name: index[name] for name in index.files}
+
+
+class AudioCache:
+    """Process-wide, thread-safe LRU cache of audio file bytes bounded by a total byte budget"""
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def get(self, file_name: str) -> bytes:
+        """Return the bytes for a file, reading from disk only if not already cached"""
+        with self._lock:
+            if file_name in self._entries:
+                self._entries.move_to_end(file_name)
+                self.hits += 1
+                return self._entries[file_name]
+            self.misses += 1
+
+        data = self._read(file_name)
+
+        with self._lock:
+            self._store(file_name, data, evict=True)
+        return data
+
+    def warm(self, file_names) -> None:
+        """Load files into the cache until the byte budget is filled, without counting hits or misses"""
+        for file_name in file_names:
+            with self._lock:
+                if file_name in self._entries:
+                    continue
+            data = self._read(file_name)
+            if len(data) > self.max_bytes:
+                continue
+            with self._lock:
+                if not self._store(file_name, data, evict=False):
+                    break
+
+    def prefetch(self, file_names) -> None:
+        """Read files into the cache in a background thread, without counting hits or misses"""
+        self._executor.submit(self._prefetch, list(file_names))
+
+    def stats(self) -> dict:
+        """Summarize cache usage"""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _read(self, file_name: str) -> bytes:
+        with open(self.directory / file_name, "rb") as file:
+            return file.read()
+
+    def _prefetch(self, file_names: list) -> None:
+        for file_name in file_names:
+            with self._lock:
+                if file_name in self._entries:
+                    self._entries.move_to_end(file_name)
+                    continue
+            data = self._read(file_name)
+            with self._lock:
+                self._store(file_name, data, evict=True)
+
+    def _store(self, file_name: str, data: bytes, evict: bool) -> bool:
+        """Add an entry, evicting least recently used entries if allowed. Caller must hold the lock."""
+        size = len(data)
+        if file_name in self._entries:
+            return True
+        if size > self.max_bytes:
+            return False
+        if not evict and self.current_bytes + size > self.max_bytes:
+            return False
+        while self.current_bytes + size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.current_bytes -= len(evicted)
+        self._entries[file_name] = data
+        self.current_bytes += size
+        return True
+
+
+@st.cache_resource
+def load_audio_cache():
+    cache = AudioCache(AUDIO_DIR, max_bytes=AUDIO_CACHE_MAX_BYTES)
+    file_names = [record["file_name"] for records in catalogue.load().records.values() for record in records]
+    threading.Thread(target=cache.warm, args=(file_names,), daemon=True).start()
+    return cache
+
+
+class RatingsStore:
+    """SQLite-backed ratings with one row per recording and label, so that sessions write only what they change"""
+
+    def __init__(self, path: Path, legacy_path: Path = None):
+        self.path = path
+        with self._transaction() as connection:
+            # Write-ahead logging lets sessions read while another session writes
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS ratings (
+                    recording_id TEXT NOT NULL,
+                    label TEXT NOT NULL,
+                    value TEXT,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (recording_id, label)
+                )
+            """)
+        if legacy_path is not None and legacy_path.exists():
+            self._import_json(legacy_path)
+
+    def load(self) -> dict:
+        """Return the latest value of each label for each rated recording"""
+        with self._transaction() as connection:
+            rows = connection.execute("SELECT recording_id, label, value FROM ratings").fetchall()
+        ratings = {}
+        for recording_id, label, value in rows:
+            ratings.setdefault(recording_id, {})[label] = value
+        return ratings
+
+    def save(self, changes: list) -> None:
+        """Write (recording_id, label, value) changes, replacing earlier values for the same recording and label"""
+        if not changes:
+            return
+        now = time.time()
+        with self._transaction() as connection:
+            connection.executemany(
+                """
+                INSERT INTO ratings (recording_id, label, value, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (recording_id, label) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+                """,
+                [(recording_id, label, value, now) for recording_id, label, value in changes]
+            )
+
+    @contextmanager
+    def _transaction(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def _import_json(self, legacy_path: Path) -> None:
+        """Copy ratings from the former ratings.json the first time the database is created"""
+        with self._transaction() as connection:
+            if connection.execute("SELECT 1 FROM ratings LIMIT 1").fetchone() is not None:
+                return
+        with open(legacy_path, "r") as file:
+            legacy = json.load(file)
+        self.save([
+            (recording_id, label, rating[label])
+            for recording_id, rating in legacy.items()
+            for label in RATING_LABELS
+            if rating.get(label) is not None
+        ])
 
 
 @st.cache_resource
-def load_app_data():
-    with open(APP_DATA_PATH) as file:
-        recordings = json.load(file)
-    scientific_names = list(recordings.keys())
-    with open(BIRD_IMAGE_DATA_PATH, "r") as file:
-        images = [json.loads(line) for line in file]
-        images = {img["scientific_name"]: img for img in images}
-    return scientific_names, recordings, images
+def load_static_manifest():
+    """Paths of content-hashed copies of the processed audio and bird images in the static folder, by file name"""
+    if not STATIC_MANIFEST_PATH.exists():
+        return {}
+    with open(STATIC_MANIFEST_PATH) as file:
+        return json.load(file)
 
 
-SCIENTIFIC_NAMES, RECORDINGS, IMAGES = load_app_data()
+@st.cache_resource
+def load_ratings_store():
+    return RatingsStore(RATINGS_DB_PATH, legacy_path=RATINGS_PATH)
 
 
-def main(rate: bool):
+def main(rate: bool, static_base_url: str = None):
     page = st.session_state.get("page", "start")
     st.session_state.counter = st.session_state.get("counter", 1)
     st.session_state.correctness = st.session_state.get("correctness", [])
 
     if rate:
         st.session_state.rate = True
-        st.session_state.ratings = st.session_state.get("ratings", load_ratings())
+        if page != "start" and "ratings" not in st.session_state:
+            st.session_state.ratings = load_ratings()
+            st.session_state.saved_ratings = {
+                recording_id: dict(rating) for recording_id, rating in st.session_state.ratings.items()
+            }
     else:
         st.session_state.rate = False
         st.session_state.ratings = {}
 
+    st.session_state.static_base_url = static_base_url
+
     if page == "start":
         show_start_page()
     elif st.session_state.counter > NUMBER_QUESTIONS:
@@ -75,6 +378,8 @@ def show_start_page():
     [CC BY-NC-SA 4.0](https://creativecommons.org/licenses/by-nc-sa/4.0).
     """)
 
+    st.checkbox("Hard mode", key="hard", help="Pair each bird with birds that sound alike")
+
     if st.button("Start game", key=f"btn_start"):
         st.session_state.page = "question"
         generate_question()
@@ -86,6 +391,10 @@ def show_question_page():
     progress_widget()
     st.markdown("### Which is the odd bird?")
 
+    # Read the next question's audio while this one is played, ready to be sent from the review page
+    if st.session_state.static_base_url is None:
+        load_audio_cache().prefetch(recording["file_name"] for recording in next_recordings())
+
     opt_1 = render_option(0, st.session_state.recordings[0], active=True)
     if st.session_state.rate:
         render_ratings(st.session_state.recordings[0])
@@ -130,14 +439,19 @@ def show_review_page():
     if st.session_state.rate:
         render_ratings(st.session_state.recordings[2])
 
-    if st.button("Next", key=f"btn_next"):
-        if st.session_state.rate:
-            save_ratings()
-        st.session_state.page = "question"
-        st.session_state.counter += 1
-        st.session_state.correctness.append(correct)
-        generate_question()
-        st.rerun()
+    preload_next_question()
+
+    st.button("Next", key=f"btn_next", on_click=next_question, args=(correct,))
+
+
+def next_question(correct):
+    # Run as the button's callback, so the rerun it triggers shows the next question without first redrawing the review
+    if st.session_state.rate:
+        save_ratings(st.session_state.recordings)
+    st.session_state.page = "question"
+    st.session_state.counter += 1
+    st.session_state.correctness.append(correct)
+    generate_question()
 
 
 def show_conclusion_page():
@@ -157,45 +471,99 @@ def show_conclusion_page():
 
 
 def load_ratings():
-    if RATINGS_PATH.exists():
-        with open(RATINGS_PATH, "r") as file:
-            ratings = json.load(file)
-    else:
-        ratings = {}
-        for bird, records in RECORDINGS.items():
-            for record in records:
-                ratings[record["recording_id"]] = {
-                    "start_sec": record["start_sec"],
-                    "end_sec": record["end_sec"],
-                    "Noise": None,
-                    "Presence": None,
-                    "Multiple": None,
-                }
+    stored = load_ratings_store().load()
+    ratings = {}
+    for bird, records in catalogue.load().records.items():
+        for record in records:
+            recording_id = record["recording_id"]
+            ratings[recording_id] = {
+                "start_sec": record["start_sec"],
+                "end_sec": record["end_sec"],
+                **{label: stored.get(recording_id, {}).get(label) for label in RATING_LABELS},
+            }
     return ratings
 
 
-def save_ratings():
-    with open(RATINGS_PATH, "w") as file:
-        json.dump(st.session_state.ratings, fp=file, indent=4)
+def save_ratings(recordings):
+    """Write the ratings this session changed for the given recordings, leaving other sessions' ratings intact"""
+    changes = []
+    for recording in recordings:
+        recording_id = recording["recording_id"]
+        rating = st.session_state.ratings[recording_id]
+        saved = st.session_state.saved_ratings[recording_id]
+        for label in RATING_LABELS:
+            if rating[label] != saved[label]:
+                changes.append((recording_id, label, rating[label]))
+                saved[label] = rating[label]
+    load_ratings_store().save(changes)
 
 
 def audio_widget(recording):
-    file_path = AUDIO_DIR / recording["file_name"]
-    audio_file = open(file_path, "rb")
-    audio_bytes = audio_file.read()
+    url = static_url("audio", recording["file_name"])
+    if url is not None:
+        st.audio(url, format="audio/mp3")
+        return
+    audio_bytes = load_audio_cache().get(recording["file_name"])
     st.audio(audio_bytes, format="audio/mp3")
 
 
-def generate_question():
-    odd_bird, paired_bird = random.sample(SCIENTIFIC_NAMES, k=2)
-    odd_list = random.sample(RECORDINGS[odd_bird], k=1)
-    paired_list = random.sample(RECORDINGS[paired_bird], k=2)
-    complete_list = odd_list + paired_list
-    order = random.sample(range(3), k=3)
+def static_url(kind, file_name):
+    """The static URL of an audio file or image when serving static assets, otherwise None"""
+    if st.session_state.static_base_url is None:
+        return None
+    path = load_static_manifest().get(kind, {}).get(file_name)
+    if path is None:
+        return None
+    return f"{st.session_state.static_base_url.rstrip('/')}/{path}"
+
 
-    st.session_state.key = order.index(0)
-    st.session_state.recordings = [complete_list[j] for j in order]
-    st.session_state.images = [IMAGES[rec["scientific_name"]] for rec in st.session_state.recordings]
+def generate_question():
+    # Draw the whole round when it starts, so no recording is heard twice in a round
+    if "round" not in st.session_state:
+        index = load_question_index()
+        hard = st.session_state.get("hard", False)
+        if hard and index.similarity is None:
+            st.toast("Hard mode is unavailable until the similarity index is built, so this round is in normal mode")
+            hard = False
+        st.session_state.round = index.sample_rounds(1, NUMBER_QUESTIONS, hard=hard)
+    ids, keys = st.session_state.round
+    i = min(st.session_state.counter, NUMBER_QUESTIONS) - 1
+
+    st.session_state.key = int(keys[0, i])
+    st.session_state.recordings = [load_question_index().recordings[j] for j in ids[0, i]]
+    st.session_state.images = [catalogue.load().birds[rec["scientific_name"]] for rec in st.session_state.recordings]
+
+
+def next_recordings():
+    """The recordings of the question after the current one, or an empty list at the end of the round"""
+    if st.session_state.counter >= NUMBER_QUESTIONS:
+        return []
+    ids, _ = st.session_state.round
+    return [load_question_index().recordings[j] for j in ids[0, st.session_state.counter]]
+
+
+def preload_next_question():
+    """Have the browser fetch the next question's audio while the review page is showing"""
+    # Audio elements without controls are not drawn, and preload="auto" asks for the whole file rather than only its
+    # metadata, which is all that st.audio players load before they are played
+    urls = [preload_url(i, recording) for i, recording in enumerate(next_recordings())]
+    tags = "".join(f'<audio preload="auto" src="{html.escape(url)}"></audio>' for url in urls if url is not None)
+    if tags:
+        st.html(tags)
+
+
+def preload_url(i, recording):
+    """The URL the next question's player will fetch a recording from, or None outside of `streamlit run`"""
+    url = static_url("audio", recording["file_name"])
+    if url is not None:
+        return url
+    if not runtime.exists():
+        return None
+    # Media files are named by a hash of their bytes and type, so the player on the next page gets the same URL
+    audio_bytes = load_audio_cache().get(recording["file_name"])
+    url = runtime.get_instance().media_file_mgr.add(audio_bytes, "audio/mp3", f"preload.{i}")
+    base_path = st.get_option("server.baseUrlPath").strip("/")
+    return f"/{base_path}{url}" if base_path else url
 
 
 def render_option(i, recording, active=True):
@@ -227,7 +595,7 @@ def render_option(i, recording, active=True):
             else:
                 recording_lic_text, recording_lic_number = PurePosixPath(recording["license"]).parts[-2:]
                 scientific_name = recording["scientific_name"]
-                image = IMAGES[scientific_name]
+                image = catalogue.load().birds[scientific_name]
                 image_lic_text, image_lic_number = PurePosixPath(image["license_url"]).parts[-3:-1]
                 st.write(f"""
                     **{recording["common_name"]}**
@@ -248,7 +616,9 @@ def render_option(i, recording, active=True):
             if active:
                 st.markdown("<h1 style='text-align: center; color: gray;'>?</h1>", unsafe_allow_html=True)
             else:
-                st.image(BIRD_IMAGE_DIR / (recording["scientific_name"] + ".jpg"), use_container_width=False)
+                image_name = recording["scientific_name"] + ".jpg"
+                image_source = static_url("images", image_name) or BIRD_IMAGE_DIR / image_name
+                st.image(image_source, use_container_width=False)
 
     return selected
 
@@ -309,7 +679,16 @@ if __name__ == "__main__":
         action="store_true",
         help="Enable rating mode"
     )
+    parser.add_argument(
+        "--static",
+        nargs="?",
+        const=STATIC_URL,
+        default=None,
+        help="Serve audio and images from content-hashed static files, at this base URL if given and otherwise from "
+             "Streamlit's static file serving (requires server.enableStaticServing, and sends no long-lived caching "
+             "headers, so see the README for serving the files from a static host)"
+    )
 
     args, _ = parser.parse_known_args()
 
-    main(args.rate)
+    main(args.rate, args.static)
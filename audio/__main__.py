@@ -0,0 +1,31 @@
+import argparse
+from audio import instrument, pipeline
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m audio")
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=list(pipeline.STAGES),
+        default=None,
+        help="Stages to run, in dependency order (default: all)"
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of partitions of a stage to build in parallel"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Rebuild every partition regardless of recorded fingerprints"
+    )
+
+    instrument.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    instrument.configure(trace_path=args.trace, profile=args.profile)
+    pipeline.main(stages=args.stages, jobs=args.jobs, force=args.force)
@@ -1,72 +1,410 @@
+import argparse
+import hashlib
+import importlib.metadata
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import cache, cached_property, partial
 import numpy as np
 import pandas as pd
 from pathlib import Path
 import librosa
-from librosa.feature import rms
-from birdnetlib import Recording
+from birdnetlib import RecordingBuffer
 from birdnetlib.analyzer import Analyzer
+from birdnetlib.utils import return_week_48_from_datetime
 import pyloudnorm
+from audio import embeddings, instrument, storage
 
 pd.set_option('future.no_silent_downcasting', True)
 
 
 BASE_DIR = Path(__file__).resolve().parent
 RAW_DIR = BASE_DIR / "data" / "raw"
-MANIFEST_PATH = BASE_DIR / "data" / "manifest.csv"
-ANALYSIS_PATH = BASE_DIR / "data" / "analysis.csv"
+CACHE_DIR = BASE_DIR / "data" / "analysis_cache"
+MANIFEST_COLUMNS = ["gen", "sp", "lat", "lon", "date"]
 
 # Settings for birdnet model and presence analysis
 WEIGHTS = np.square(np.linspace(2, 1, 4))
 OVERLAP = 1  # Overlap is a misnomer. Value of one means that three seconds frames have two seconds of overlap.
 MIN_CONF = 0
+MODEL_VERSION = importlib.metadata.version("birdnetlib")
 
+# Settings for decoding. Each file is decoded once at the rate BirdNET expects and only the window around the
+# detected presence is resampled to the rate used for onset detection and clip metrics.
+BIRDNET_RATE = 48000
+FRAME_SECONDS = 3  # Length of the frames BirdNET takes, which clips are split into to embed them
+METRICS_RATE = 22050
+ONSET_PADDING = 2  # Seconds of context kept either side of the window that onset detection searches
+PIPELINE_VERSION = 5  # Increment when a change to the analysis would alter cached results
 
-def main() -> None:
+# Settings for the short-time features shared by onset detection and the clip metrics, which are librosa's defaults
+FRAME_LENGTH = 2048
+HOP_LENGTH = 512
+ROLLING_FRAMES = 10  # Frames of RMS averaged when finding the floor and peak of a clip
+
+# Settings for batched inference. Files are decoded in groups and their frames are passed to BirdNET together.
+FILES_PER_GROUP = 8
+
+
+def main(workers: int = 1, rebuild: bool = False, batch_size: int | None = None) -> None:
     """Analyze all .mp3 files in the raw data directory and write a .csv of the results"""
-    analyzer = Analyzer()
+    manifest = storage.read_table("manifest", columns=MANIFEST_COLUMNS)
+
+    files = recorded_files(manifest)
+    tasks = build_tasks(files, manifest)
+    analysis_results = analyze_tasks(tasks, workers=workers, rebuild=rebuild, batch_size=batch_size)
+    with instrument.span("analyze", "write"):
+        write_analysis(files, analysis_results)
+
 
-    manifest = pd.read_csv(MANIFEST_PATH, dtype={'id': str}, index_col='id')
+def recorded_files(manifest: pd.DataFrame) -> list:
+    """List the raw recordings that are in the manifest, in name order"""
+    # Recordings of species removed from the list stay in the raw directory but have no manifest row to analyze with
+    return sorted(filepath for filepath in RAW_DIR.glob("*.mp3") if filepath.stem in manifest.index)
 
-    files = list(RAW_DIR.glob("*.mp3"))
-    n = len(files)
 
-    analysis_results = []
-    for i, filepath in enumerate(files):
-        print(i + 1, "of", n, ":", filepath)
+def build_tasks(files: list, manifest: pd.DataFrame, digests: dict | None = None) -> list:
+    """Describe the analysis of each file, including the key of its result in the cache"""
+    tasks = []
+    for filepath in files:
         row = manifest.loc[filepath.stem]
-        scientific_name = row["gen"] + " " + row["sp"]
-        try:
+        task = {
+            "filepath": filepath,
+            "scientific_name": row["gen"] + " " + row["sp"],
+            "lat": row["lat"],
+            "lon": row["lon"],
+            "date": pd.to_datetime(row["date"]),
+        }
+        task["key"] = cache_key(task, digest=None if digests is None else digests.get(filepath))
+        tasks.append(task)
+    return tasks
+
+
+def analyze_tasks(tasks: list, workers: int = 1, rebuild: bool = False, batch_size: int | None = None) -> dict:
+    """Analyze the files that have no cached result, returning results by recording id for all that succeed"""
+    analysis_results = {}
+    uncached = []
+    for task in tasks:
+        cached = None if rebuild else load_cached_result(task["key"])
+        if cached is None:
+            uncached.append(task)
+        else:
+            analysis_results[task["filepath"].stem] = cached
+
+    print("Found", len(analysis_results), "cached results,", len(uncached), "files to analyze")
+
+    keys = {task["filepath"]: task["key"] for task in uncached}
+    for i, (filepath, result, error) in enumerate(run_tasks(uncached, workers=workers, batch_size=batch_size)):
+        print(i + 1, "of", len(uncached), ":", filepath)
+        if error is None:
+            # Checkpoint each result as soon as it is available so an interrupted run can resume
+            save_cached_result(keys[filepath], result)
+            analysis_results[filepath.stem] = result
+        else:
+            print("Error processing", filepath)
+            print(error)
+
+    return analysis_results
+
+
+def write_analysis(files: list, analysis_results: dict) -> None:
+    """Write the analysis table, with rows in file order so that output does not depend on the order work finished,
+    and the embeddings of the clips"""
+    ordered_results = [analysis_results[fp.stem] for fp in files if fp.stem in analysis_results]
+    analysis_df = pd.DataFrame([
+        {k: v for k, v in result.items() if k != "embedding"} for result in ordered_results
+    ]).set_index('id')
+    path = storage.write_table(analysis_df, "analysis")
+    print("Wrote analysis for", len(analysis_df), "of", len(files), "files:", path)
+    embeddings.write_store({result["id"]: result["embedding"] for result in ordered_results})
+
+
+def file_digest(filepath: Path) -> str:
+    """Hash the content of a file"""
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(task: dict, digest: str | None = None) -> str:
+    """Hash the file content together with everything else that determines its analysis result"""
+    settings = {
+        "content": digest or file_digest(task["filepath"]),
+        "scientific_name": task["scientific_name"],
+        "lat": task["lat"],
+        "lon": task["lon"],
+        "date": str(task["date"]),
+        "weights": WEIGHTS.tolist(),
+        "overlap": OVERLAP,
+        "min_conf": MIN_CONF,
+        "model_version": MODEL_VERSION,
+        "pipeline_version": PIPELINE_VERSION,
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+
+def load_cached_result(key: str) -> dict | None:
+    """Return a previously stored analysis result, or None if there is none"""
+    path = CACHE_DIR / (key + ".json")
+    if not path.exists() or not path.with_suffix(".npy").exists():
+        return None
+    with open(path) as file:
+        result = json.load(file)
+    result["embedding"] = np.load(path.with_suffix(".npy"))
+    return result
+
+
+def save_cached_result(key: str, result: dict) -> None:
+    """Store an analysis result, writing to a temporary file first so that a crash never leaves a partial entry"""
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    path = CACHE_DIR / (key + ".json")
+    # The embedding is written first, so an entry whose .json exists always has its embedding
+    tmp_path = path.with_suffix(".tmp.npy")
+    np.save(tmp_path, result["embedding"])
+    os.replace(tmp_path, path.with_suffix(".npy"))
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as file:
+        json.dump({k: v for k, v in result.items() if k != "embedding"}, file, default=float)
+    os.replace(tmp_path, path)
+
+
+def run_tasks(tasks: list, workers: int = 1, batch_size: int | None = None):
+    """Analyze files serially or across a process pool, yielding (filepath, result, error) as each completes"""
+    if batch_size is None:
+        groups = [[task] for task in tasks]
+    else:
+        groups = [tasks[i:i + FILES_PER_GROUP] for i in range(0, len(tasks), FILES_PER_GROUP)]
+    work = partial(analyze_task_group, batch_size=batch_size)
+    # With every result cached there is nothing to run, so the model is not loaded
+    if not groups:
+        return
+
+    if workers <= 1:
+        init_worker()
+        for group in groups:
+            yield from work(group)
+        return
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker) as executor:
+        futures = [executor.submit(work, group) for group in groups]
+        for future in as_completed(futures):
+            yield from future.result()
+
+
+_worker_analyzer = None
+
+
+def init_worker() -> None:
+    """Build one analyzer per process so the model is loaded once and reused for every file"""
+    global _worker_analyzer
+    if _worker_analyzer is None:
+        with instrument.span("analyze", "load_model"):
+            _worker_analyzer = Analyzer()
+
+
+def analyze_task(task: dict) -> tuple:
+    """Analyze one file with the process's analyzer, capturing any error rather than raising it"""
+    filepath = task["filepath"]
+    try:
+        with instrument.span("analyze", "file", item=filepath.stem), instrument.profile("analyze", filepath.stem):
             result = analyze_file(
                 filepath,
+                analyzer=_worker_analyzer,
+                scientific_name=task["scientific_name"],
                 weights=WEIGHTS,
-                analyzer=analyzer,
-                scientific_name=scientific_name,
-                lat=row["lat"],
-                lon=row["lon"],
-                date=pd.to_datetime(row["date"]),
+                lat=task["lat"],
+                lon=task["lon"],
+                date=task["date"],
+                overlap=OVERLAP,
+                min_conf=MIN_CONF,
+            )
+        result['id'] = filepath.stem
+        return filepath, result, None
+    except Exception as ex:
+        # Return the message rather than the exception, which may not survive pickling between processes
+        return filepath, None, str(ex)
+
+
+def analyze_task_group(tasks: list, batch_size: int | None = None) -> list:
+    """Analyze a group of files, running BirdNET on their frames together when a batch size is given"""
+    if batch_size is None:
+        return [analyze_task(task) for task in tasks]
+
+    outcomes = {}
+    recordings = {}
+    for task in tasks:
+        filepath = task["filepath"]
+        try:
+            with instrument.span("analyze", "decode", item=filepath.stem):
+                data = decode_audio(filepath, rate=BIRDNET_RATE)
+            recordings[filepath] = RecordingBuffer(
+                _worker_analyzer,
+                data,
+                BIRDNET_RATE,
+                lat=task["lat"],
+                lon=task["lon"],
+                date=task["date"],
                 overlap=OVERLAP,
                 min_conf=MIN_CONF,
             )
+        except Exception as ex:
+            outcomes[filepath] = (filepath, None, str(ex))
+
+    try:
+        with instrument.span("analyze", "birdnet_batch", item=",".join(fp.stem for fp in recordings)):
+            detections = detect_batched(_worker_analyzer, list(recordings.values()), batch_size=batch_size)
+    except Exception as ex:
+        for filepath in recordings:
+            outcomes[filepath] = (filepath, None, str(ex))
+        recordings, detections = {}, []
+
+    tasks_by_path = {task["filepath"]: task for task in tasks}
+    for filepath, recording_detections in zip(list(recordings), detections):
+        task = tasks_by_path[filepath]
+        # Each recording is dropped once its clip window is taken, so only one full buffer is released at a time
+        recording = recordings.pop(filepath)
+        try:
+            # Decoding and BirdNET ran for the whole group, so each file's record covers the work after detection
+            with instrument.span("analyze", "file", item=filepath.stem), instrument.profile("analyze", filepath.stem):
+                with instrument.span("analyze", "score", item=filepath.stem):
+                    presence = score_presence(recording_detections, task["scientific_name"], WEIGHTS,
+                                              overlap=recording.overlap)
+                window_start, window = clip_window(recording.buffer, presence[0], presence[1])
+                del recording
+                with instrument.span("analyze", "summarize", item=filepath.stem):
+                    result = summarize_file(window, window_start, task["scientific_name"], *presence)
+                with instrument.span("analyze", "embed", item=filepath.stem):
+                    result["embedding"] = embed_clip(_worker_analyzer, window, result["start"] - window_start,
+                                                     result["end"] - window_start)
             result['id'] = filepath.stem
-            analysis_results.append(result)
+            outcomes[filepath] = (filepath, result, None)
         except Exception as ex:
-            print("Error processing", filepath)
-            print(ex)
-
-    analysis_df = pd.DataFrame(analysis_results).set_index('id')
-    analysis_df.to_csv(ANALYSIS_PATH)
+            outcomes[filepath] = (filepath, None, str(ex))
+
+    return [outcomes[task["filepath"]] for task in tasks]
+
+
+def detect_batched(analyzer: Analyzer, recordings: list, batch_size: int) -> list:
+    """Run BirdNET over the frames of many recordings in fixed-size batches, returning detections per recording"""
+    if analyzer.use_custom_classifier:
+        raise ValueError("Batched inference does not support custom classifiers")
+    # The check `Analyzer.analyze_recording` makes before predicting, as a location would replace the custom list
+    if analyzer.has_custom_species_list and any(recording.lon and recording.lat for recording in recordings):
+        raise ValueError("Recording lon/lat should not be used in conjunction with a custom species list or path.")
+
+    # Split each recording into three second frames exactly as `Recording.analyze` would
+    for recording in recordings:
+        if recording.week_48 != -1:
+            recording.week_48 = max(1, min(recording.week_48, 48))
+        if recording.date:
+            recording.week_48 = return_week_48_from_datetime(recording.date)
+        recording.read_audio_data()
+
+    frame_counts = [len(recording.chunks) for recording in recordings]
+    frames = [chunk for recording in recordings for chunk in recording.chunks]
+
+    # Pad the final batch so the interpreter keeps one input shape and never needs reallocating
+    tic = time.perf_counter()
+    logits = []
+    batch = np.zeros((batch_size, len(frames[0]) if frames else 0), dtype=np.float32)
+    analyzer.interpreter.resize_tensor_input(analyzer.input_layer_index, batch.shape)
+    analyzer.interpreter.allocate_tensors()
+    for i in range(0, len(frames), batch_size):
+        n = min(batch_size, len(frames) - i)
+        batch[:n] = frames[i:i + n]
+        batch[n:] = 0
+        analyzer.interpreter.set_tensor(analyzer.input_layer_index, batch)
+        analyzer.interpreter.invoke()
+        logits.append(analyzer.interpreter.get_tensor(analyzer.output_layer_index)[:n].copy())
+    elapsed = time.perf_counter() - tic
+    print(f"Batched inference: {len(frames)} frames in {elapsed:.1f} s "
+          f"({len(frames) / max(elapsed, 1e-9):.1f} frames/sec)")
+
+    # Map predictions back to each recording and frame start time, filtering as `Analyzer.analyze_recording` does
+    logits = np.concatenate(logits) if logits else np.empty((0, len(analyzer.labels)))
+    offsets = np.cumsum([0] + frame_counts)
+    detections = []
+    for recording, first, last in zip(recordings, offsets[:-1], offsets[1:]):
+        if recording.lon and recording.lat and analyzer.classifier_model_path is None:
+            analyzer.set_predicted_species_list_from_position(recording)
+
+        predictions = analyzer.flat_sigmoid(logits[first:last], sensitivity=-recording.sensitivity)
+        start = 0
+        end = recording.sample_secs
+        results = {}
+        for prediction in predictions:
+            keep = np.flatnonzero(prediction >= recording.minimum_confidence)
+            keep = keep[np.argsort(-prediction[keep], kind="stable")]
+            results[str(start) + "-" + str(end)] = [(analyzer.labels[j], prediction[j]) for j in keep]
+            start += recording.sample_secs - recording.overlap
+            end = start + recording.sample_secs
+
+        analyzer.results = results
+        recording.detection_list = analyzer.detections
+        recording.analyzed = True
+
+        # Read detections while this recording's location species list is active on the analyzer
+        detections.append(recording.detections)
+
+    return detections
 
 
 def analyze_file(filepath: Path, analyzer: Analyzer, scientific_name: str, weights: np.ndarray, **kwargs) -> dict:
     """Run all analysis tasks for a given file"""
+    if analyzer is None:
+        analyzer = Analyzer()
+    with instrument.span("analyze", "decode"):
+        data = decode_audio(filepath, rate=BIRDNET_RATE)
+
     presence_start, presence_end, df = analyze_presence(
         analyzer,
-        filepath=filepath,
+        data=data,
+        rate=BIRDNET_RATE,
         scientific_name=scientific_name,
         weights=weights,
         **kwargs
     )
 
+    # Keep only the part of the recording the clip can come from, so the full buffer is released before the metrics
+    window_start, window = clip_window(data, presence_start, presence_end)
+    del data
+
+    result = summarize_file(window, window_start, scientific_name, presence_start, presence_end, df)
+    with instrument.span("analyze", "embed"):
+        result["embedding"] = embed_clip(analyzer, window, result["start"] - window_start, result["end"] - window_start)
+    return result
+
+
+def clip_window(data: np.ndarray, presence_start: float, presence_end: float) -> tuple:
+    """The start in seconds and a copy of the part of decoded audio that onset detection and the clip can reach"""
+    duration = presence_end - presence_start
+    window_start = max(presence_start - 1 - ONSET_PADDING, 0)
+    window_end = presence_start + 3 + duration + ONSET_PADDING
+    # A copy rather than a view, which would keep the whole buffer alive
+    return window_start, data[int(window_start * BIRDNET_RATE):int(window_end * BIRDNET_RATE)].copy()
+
+
+def embed_clip(analyzer: Analyzer, data: np.ndarray, start: float, end: float) -> np.ndarray:
+    """Average BirdNET's embeddings of the frames of a clip of decoded audio, scaled to unit length"""
+    # The clip is split into consecutive frames, the last padded with silence, and embedded in one batch
+    clip = data[int(start * BIRDNET_RATE):int(end * BIRDNET_RATE)]
+    frame_length = FRAME_SECONDS * BIRDNET_RATE
+    n_frames = max(1, -(-len(clip) // frame_length))
+    frames = np.zeros((n_frames, frame_length), dtype=np.float32)
+    frames.reshape(-1)[:len(clip)] = clip
+    # This is the call birdnetlib's own `extract_embeddings` makes for each frame of a whole recording
+    vectors = analyzer._return_embeddings(frames)
+    return embeddings.normalize(np.mean(vectors, axis=0))
+
+
+def summarize_file(window: np.ndarray, window_start: float, scientific_name: str, presence_start: float,
+                   presence_end: float, df: pd.DataFrame) -> dict:
+    """Combine presence results with onset and clip metrics for the best segment, given the window holding it"""
     # Start a dictionary of results to return
     result = {
         "scientific_name": scientific_name,
@@ -75,63 +413,112 @@ def analyze_file(filepath: Path, analyzer: Analyzer, scientific_name: str, weigh
         "presence_score": df['score'].max(),
     }
 
-    data, rate = librosa.load(filepath)
+    # Resample only the part of the recording that onset detection and the clip can reach
+    duration = presence_end - presence_start
+    with instrument.span("analyze", "resample"):
+        window = librosa.resample(window, orig_sr=BIRDNET_RATE, target_sr=METRICS_RATE)
 
     # Find an onset near to `presence_start` and add to dictionary
-    result['start'] = find_onset(data, rate=rate, start=result['presence_start'])
-    duration = presence_end - presence_start
+    features = Features(window, rate=METRICS_RATE)
+    with instrument.span("analyze", "onset"):
+        onset = find_onset(features, start=presence_start - window_start)
+    result['start'] = window_start + onset
     result['end'] = result['start'] + duration
 
-    # Reduce audio data to a clip
-    s = int(result['start'] * rate)
-    e = int(result['end'] * rate)
-    clip = data[s:e]
-
-    # Add metrics for the clip to the dictionary
-    result['floor_to_peak'] = floor_to_peak(clip)
-    result['loudness'] = get_loudness(clip, rate=rate)
+    # Add metrics for the clip to the dictionary, computed from the features of the window found for the onset
+    for name, metric in CLIP_METRICS.items():
+        with instrument.span("analyze", name):
+            result[name] = metric(features, onset, onset + duration)
 
     return result
 
 
-def analyze_presence(analyzer: Analyzer, filepath: Path, scientific_name: str, weights: np.ndarray, **kwargs) -> tuple:
-    """Analyze an audio file for presence of target bird, identifying the best segment"""
+class Features:
+    """Short-time features of decoded audio, each computed on first use and then shared by every metric that uses it"""
+
+    def __init__(self, data: np.ndarray, rate: int):
+        self.data = data
+        self.rate = rate
+
+    @cached_property
+    def magnitude(self) -> np.ndarray:
+        """Magnitude spectrogram, shaped (frequencies, frames)"""
+        return np.abs(librosa.stft(self.data, n_fft=FRAME_LENGTH, hop_length=HOP_LENGTH))
+
+    @cached_property
+    def onset_envelope(self) -> np.ndarray:
+        """Onset strength of each frame, computed as `librosa.onset.onset_strength` does from the audio"""
+        mel = mel_filters(self.rate) @ np.square(self.magnitude)
+        return librosa.onset.onset_strength(S=librosa.power_to_db(mel), sr=self.rate, hop_length=HOP_LENGTH)
+
+    @cached_property
+    def rms(self) -> np.ndarray:
+        """Root mean square of each windowed frame, found from the spectrogram rather than from the audio again"""
+        return librosa.feature.rms(S=self.magnitude, frame_length=FRAME_LENGTH)[0]
+
+    def frames(self, start: float, end: float) -> slice:
+        """The frames centred between two times, in seconds"""
+        return slice(int(np.ceil(start * self.rate / HOP_LENGTH)), int(np.ceil(end * self.rate / HOP_LENGTH)))
+
+    def samples(self, start: float, end: float) -> np.ndarray:
+        """The samples between two times, in seconds"""
+        return self.data[int(start * self.rate):int(end * self.rate)]
+
+
+@cache
+def mel_filters(rate: int) -> np.ndarray:
+    """The mel filter bank librosa applies to spectrograms at a sample rate, built once rather than for every file"""
+    return librosa.filters.mel(sr=rate, n_fft=FRAME_LENGTH)
+
+
+def decode_audio(filepath: Path, rate: int) -> np.ndarray:
+    """Decode an audio file once to a mono float32 buffer at the given sample rate"""
+    # Resample as birdnetlib does when it loads a file itself, so that detections match those of its own analysis
+    data, _ = librosa.load(filepath, sr=rate, mono=True, dtype=np.float32, res_type="kaiser_fast")
+    return data
+
+
+def analyze_presence(analyzer: Analyzer, data: np.ndarray, rate: int, scientific_name: str, weights: np.ndarray,
+                     **kwargs) -> tuple:
+    """Analyze decoded audio for presence of target bird, identifying the best segment"""
     if analyzer is None:
         analyzer = Analyzer()
 
-    recording = Recording(analyzer, filepath, **kwargs)
-    recording.analyze()
+    with instrument.span("analyze", "birdnet"):
+        recording = RecordingBuffer(analyzer, data, rate, **kwargs)
+        recording.analyze()
+
+    with instrument.span("analyze", "score"):
+        return score_presence(recording.detections, scientific_name, weights, overlap=recording.overlap)
+
 
+def score_presence(detections: list, scientific_name: str, weights: np.ndarray, overlap: float) -> tuple:
+    """Score every window of consecutive frames for presence of the target bird, returning the best window"""
     # Make dataframe with one row per frame summarizing presence of target bird and off target birds
-    detections = pd.DataFrame(recording.detections)
-    grouper = detections.groupby("start_time")
-    on_target = grouper.apply(
-        lambda grp: sum(grp['confidence'] * pd.Series(grp['scientific_name'] == scientific_name).astype(float)),
-        include_groups=False
-    )
-    off_target = grouper.apply(
-        lambda grp: sum(grp['confidence'] * pd.Series(grp['scientific_name'] != scientific_name).astype(float)),
-        include_groups=False
-    )
-    aggregate = pd.DataFrame({"on_target": on_target, "off_target": off_target})
+    detections = pd.DataFrame(detections)
+    is_target = detections['scientific_name'] == scientific_name
+    confidence = detections['confidence'].astype(float)
+    aggregate = pd.DataFrame({
+        "start_time": detections["start_time"],
+        "on_target": confidence.where(is_target, 0.0),
+        "off_target": confidence.where(~is_target, 0.0),
+    }).groupby("start_time").sum()
     aggregate['delta'] = aggregate["on_target"] - aggregate["off_target"]
 
     # Expand that dataframe to include any missing time points / frames
     last_start = detections["start_time"].iloc[-1]
-    increment = 3 if recording.overlap == 0 else recording.overlap  # overlap
+    increment = 3 if overlap == 0 else overlap
     expected_starts = np.arange(0, last_start + increment, increment)
     aggregate = aggregate.reindex(expected_starts).fillna(0)
 
-    # Get a weighted average score across a number of frames
+    # Get a weighted average score across a number of frames, with the score for a window stored at its first frame
     n_frames = len(weights)
-    score_holder = [pd.NA] * len(aggregate)
-    for i in range(len(aggregate) - n_frames + 1):
-        subset = aggregate.iloc[i:i + n_frames]
-        weighted_mean = np.average(subset["on_target"] - subset["off_target"], weights=weights)
-        score_holder[i] = weighted_mean
+    window_scores = np.correlate(aggregate['delta'].to_numpy(), weights, mode='valid') / np.sum(weights)
+    score = np.full(len(aggregate), np.nan)
+    score[:len(window_scores)] = window_scores
 
     # Find the best start and end times
-    aggregate['score'] = score_holder
+    aggregate['score'] = score
     best_start_frame = aggregate['score'].argmax()
     best_end_frame = best_start_frame + n_frames - 1
     best_start_time = aggregate.index[best_start_frame]
@@ -140,9 +527,10 @@ def analyze_presence(analyzer: Analyzer, filepath: Path, scientific_name: str, w
     return best_start_time, best_end_time, aggregate
 
 
-def find_onset(data: np.ndarray, rate: float, start: float, delta: float = .25) -> float:
+def find_onset(features: Features, start: float, delta: float = .25) -> float:
     """Function to find the onset of audio near to a given starting second"""
-    onsets = librosa.onset.onset_detect(y=data, sr=rate, backtrack=True, units='time', delta=delta)
+    onsets = librosa.onset.onset_detect(onset_envelope=features.onset_envelope, sr=features.rate,
+                                        hop_length=HOP_LENGTH, backtrack=True, units='time', delta=delta)
     onsets = np.array(onsets)
     onsets = onsets[onsets < start + 3]
     onsets = onsets[onsets > start - 1]
@@ -153,21 +541,60 @@ def find_onset(data: np.ndarray, rate: float, start: float, delta: float = .25)
         return float(onsets[closest])
 
 
-def get_loudness(data: np.ndarray, rate: float):
-    """Function to calculate loudness for a recording"""
-    meter = pyloudnorm.Meter(rate)
-    loudness = meter.integrated_loudness(data)
+def get_loudness(features: Features, start: float, end: float) -> float:
+    """Function to calculate loudness for a clip"""
+    # Loudness is measured on K-weighted samples rather than frames, as the standard it follows specifies
+    meter = pyloudnorm.Meter(features.rate)
+    loudness = meter.integrated_loudness(features.samples(start, end))
     return loudness
 
 
-def floor_to_peak(data: np.ndarray):
-    """Function to calculate the floor-to-peak value for a recording, representing amount of noise"""
-    r = librosa.feature.rms(y=data).flatten()
-    rolling_mean = pd.Series(r).rolling(window=10).mean().dropna()
+def floor_to_peak(features: Features, start: float, end: float) -> float:
+    """Function to calculate the floor-to-peak value for a clip, representing amount of noise"""
+    r = features.rms[features.frames(start, end)]
+    if len(r) < ROLLING_FRAMES:
+        return 0.0
+    rolling_mean = np.lib.stride_tricks.sliding_window_view(r, ROLLING_FRAMES).mean(axis=1)
     floor = rolling_mean.min()
-    peak = rolling_mean.quantile(0.95)
-    return floor / peak if peak > 0 else 0.0
+    peak = np.quantile(rolling_mean, 0.95)
+    return float(floor / peak) if peak > 0 else 0.0
+
+
+# Metrics stored for each clip, by column of the analysis table. Each is computed from the features of the window
+# holding the clip and the clip's start and end in seconds, so a new metric reuses the features already computed.
+CLIP_METRICS = {
+    "floor_to_peak": floor_to_peak,
+    "loudness": get_loudness,
+}
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes to use for analysis"
+    )
+
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Ignore cached results and analyze every file again"
+    )
+
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=None,
+        help="Run BirdNET on frames from several files together in batches of this many frames"
+    )
+
+    instrument.add_arguments(parser)
+
+    args = parser.parse_args()
+    if args.batch_size is not None and args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+
+    instrument.configure(trace_path=args.trace, profile=args.profile)
+    main(workers=args.workers, rebuild=args.rebuild, batch_size=args.batch_size)
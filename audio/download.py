@@ -1,50 +1,93 @@
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
+from requests.adapters import HTTPAdapter
+import numpy as np
 import pandas as pd
 from pathlib import Path
 from geopy.distance import distance
+from audio import instrument, storage
 
 
 BASE_DIR = Path(__file__).resolve().parent
-MANIFEST_PATH = BASE_DIR / "data" / "manifest.csv"
+MANIFEST_COLUMNS = ["gen", "sp", "length", "lat", "lon", "q", "smp", "lic", "file"]
 RAW_PATH = BASE_DIR / "data" / "raw"
 
 LATITUDE = 37
 LONGITUDE = -122
 RECORDINGS_PER_SPECIES = 100
 
+# WGS-84 ellipsoid, as used by geopy's default geodesic distance
+WGS84_A = 6378.137
+WGS84_F = 1 / 298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
 
-def main():
+QUALITY_SCORES = {"A": 1.0, "B": 0.8, "C": 0.6, "E": 0.0}
+
+# Settings for downloading
+DOWNLOAD_WORKERS = 8
+CHUNK_SIZE = 64 * 1024
+MAX_RETRIES = 3
+BACKOFF_SECONDS = 1.0
+TIMEOUT_SECONDS = 30
+
+
+def main(workers: int = DOWNLOAD_WORKERS, latitude: float = LATITUDE, longitude: float = LONGITUDE):
     """Select the top recordings by species and download them"""
-    manifest = pd.read_csv(MANIFEST_PATH, dtype={'id': str}, index_col='id')
+    with instrument.span("download", "select"):
+        manifest = storage.read_table("manifest", columns=MANIFEST_COLUMNS)
+        selection = select_recordings(manifest, latitude=latitude, longitude=longitude)
+    download_recordings(selection, workers=workers)
 
+
+def select_recordings(manifest: pd.DataFrame, latitude: float = LATITUDE, longitude: float = LONGITUDE) -> pd.DataFrame:
+    """Select the manifest rows of the top recordings by species"""
     # Do not use works with licenses prohibiting derivatives
     manifest = manifest.loc[~manifest['lic'].str.contains("-nd")]
 
-    rankings = score_and_rank_recordings(manifest)
+    rankings = score_and_rank_recordings(manifest, latitude=latitude, longitude=longitude)
     index_for_downloading = rankings.index[rankings['rank'] <= RECORDINGS_PER_SPECIES]
-    n = len(index_for_downloading)
-    counter = 0
-    for idx, row in manifest.loc[index_for_downloading].iterrows():
-        counter += 1
-        local_name = RAW_PATH / (idx + ".mp3")
-        print(counter, "of", n, ":", local_name)
-        try:
-            download_if_absent(row['file'], local_name)
-        except Exception as ex:
-            print("Error downloading record_id", idx)
-            print(ex)
+    return manifest.loc[index_for_downloading]
 
 
+def download_recordings(selection: pd.DataFrame, workers: int = DOWNLOAD_WORKERS) -> list:
+    """Download the selected recordings that are absent, returning the ids of any that failed"""
+    n = len(selection)
+    failed = []
 
-def score_and_rank_recordings(manifest: pd.DataFrame) -> pd.DataFrame:
-    """Score and rank order (by species) the files available for download"""
+    session = make_session(pool_size=workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for idx, row in selection.iterrows():
+            local_name = RAW_PATH / (idx + ".mp3")
+            futures[executor.submit(download_if_absent, row['file'], local_name, session=session)] = (idx, local_name)
+
+        for counter, future in enumerate(as_completed(futures), start=1):
+            idx, local_name = futures[future]
+            print(counter, "of", n, ":", local_name)
+            try:
+                if not future.result():
+                    failed.append(idx)
+            except Exception as ex:
+                print("Error downloading record_id", idx)
+                print(ex)
+                failed.append(idx)
+
+    return failed
+
+
+def score_and_rank_recordings(manifest: pd.DataFrame, latitude: float = LATITUDE,
+                              longitude: float = LONGITUDE) -> pd.DataFrame:
+    """Score and rank order (by species) the files available for download, preferring those near a reference point"""
     # Use only rows having all necessary data points
     df = manifest[['gen', 'sp', 'length', 'lat', 'lon', 'q', 'smp']].copy()
     df = df.dropna()
 
     # Calculate values needed for scoring
-    df['seconds'] = df['length'].apply(time_to_seconds)
-    df['km'] = df.apply(lambda row: distance((LATITUDE, LONGITUDE), (row['lat'], row['lon'])).km, axis=1)
+    df['seconds'] = time_to_seconds(df['length'])
+    df['km'] = geodesic_km(latitude, longitude, df['lat'].to_numpy(float), df['lon'].to_numpy(float))
 
     # Apply some filter using hard limits
     df = df.loc[df['seconds'] >= 30]
@@ -53,75 +96,194 @@ def score_and_rank_recordings(manifest: pd.DataFrame) -> pd.DataFrame:
 
     # Score and rank recordings available for download
     output = df[['gen', 'sp', 'km', 'seconds']].copy()
-    output['quality_score'] = df['q'].apply(score_quality)
-    output['seconds_score'] = df['seconds'].apply(score_seconds)
-    output['distance_score'] = df['km'].apply(score_distance)
+    output['quality_score'] = score_quality(df['q'])
+    output['seconds_score'] = score_seconds(df['seconds'].to_numpy())
+    output['distance_score'] = score_distance(df['km'].to_numpy())
     output['final_score'] = output[['quality_score', 'seconds_score', 'distance_score']].sum(axis=1)
     output['rank'] = output.groupby(['gen', 'sp'])['final_score'].rank(method='first')
 
     return output
 
 
-def time_to_seconds(x: str) -> int:
-    """Convert a string like hh:mm:ss or mm:ss to an integer count of seconds"""
-    splits = [int(s) for s in x.split(":")]
-    if len(splits) == 2:
-        splits = [0] + splits
-    elif len(splits) != 3:
+def time_to_seconds(x: pd.Series) -> pd.Series:
+    """Convert strings like hh:mm:ss or mm:ss to integer counts of seconds"""
+    n_parts = x.str.count(":") + 1
+    if not n_parts.isin([2, 3]).all():
         raise ValueError("Expected hh:mm:ss or mm:ss")
-    return sum([s*60**(2-i) for i, s in enumerate(splits)])
-
-
-def score_seconds(x: int) -> float:
-    """Score a recording duration on the range zero to one"""
-    if x < 30:
-        return 0.0
-    elif x < 60:
-        return (x / 60)**2
-    else:
-        return (60 / x)**1
-
-
-def score_quality(x: str) -> float:
-    """Score a recording for quality rating on the range zero to one"""
-    if x == "A":
-        return 1.0
-    elif x == "B":
-        return 0.8
-    elif x == "C":
-        return 0.6
-    elif x == "E":
-        return 0.0
-    else:
-        return 0.3
-
-
-def score_distance(x: float) -> float:
-    """Score a recording based on distance (closer is better) on the range zero to one"""
-    if x > 5000:
-        return 0.0
-    else:
-        return 1 - (x/5000)**2
-
-
-def download_if_absent(url: str, filepath: str) -> bool:
+
+    # Accumulate left to right so that mm:ss and hh:mm:ss rows are handled together
+    parts = x.str.split(":", expand=True)
+    seconds = pd.Series(0, index=x.index)
+    for column in parts.columns:
+        values = parts[column]
+        present = values.notna()
+        seconds[present] = seconds[present] * 60 + values[present].astype(int)
+    return seconds
+
+
+def geodesic_km(latitude: float, longitude: float, lats: np.ndarray, lons: np.ndarray,
+                tolerance: float = 1e-12, max_iterations: int = 200) -> np.ndarray:
+    """Geodesic distances in kilometers from one point to many on the WGS-84 ellipsoid (Vincenty's inverse formula)"""
+    lats = np.asarray(lats, dtype=float)
+    lons = np.asarray(lons, dtype=float)
+
+    u1 = np.arctan((1 - WGS84_F) * np.tan(np.radians(latitude)))
+    u2 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lats)))
+    big_l = np.radians(lons - longitude)
+    sin_u1, cos_u1 = np.sin(u1), np.cos(u1)
+    sin_u2, cos_u2 = np.sin(u2), np.cos(u2)
+
+    lam = big_l.copy()
+    converged = np.zeros(lam.shape, dtype=bool)
+    for _ in range(max_iterations):
+        sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+        sin_sigma = np.hypot(cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam)
+        cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+        sigma = np.arctan2(sin_sigma, cos_sigma)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sin_alpha = np.where(sin_sigma == 0, 0.0, cos_u1 * cos_u2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha ** 2
+            cos_2sigma_m = np.where(cos2_alpha == 0, 0.0, cos_sigma - 2 * sin_u1 * sin_u2 / cos2_alpha)
+        c = WGS84_F / 16 * cos2_alpha * (4 + WGS84_F * (4 - 3 * cos2_alpha))
+        lam_previous = lam
+        lam = big_l + (1 - c) * WGS84_F * sin_alpha * (
+            sigma + c * sin_sigma * (cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2))
+        )
+        converged = np.abs(lam - lam_previous) < tolerance
+        if converged.all():
+            break
+
+    u_squared = cos2_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+    big_a = 1 + u_squared / 16384 * (4096 + u_squared * (-768 + u_squared * (320 - 175 * u_squared)))
+    big_b = u_squared / 1024 * (256 + u_squared * (-128 + u_squared * (74 - 47 * u_squared)))
+    delta_sigma = big_b * sin_sigma * (cos_2sigma_m + big_b / 4 * (
+        cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)
+        - big_b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)
+    ))
+    km = WGS84_B * big_a * (sigma - delta_sigma)
+
+    # Vincenty's formula does not converge for nearly antipodal points, so fall back to geopy for those
+    for i in np.flatnonzero(~converged):
+        km[i] = distance((latitude, longitude), (lats[i], lons[i])).km
+
+    return km
+
+
+def score_seconds(x: np.ndarray) -> np.ndarray:
+    """Score recording durations on the range zero to one"""
+    x = np.asarray(x, dtype=float)
+    with np.errstate(divide="ignore"):
+        return np.select([x < 30, x < 60], [0.0, (x / 60)**2], (60 / x)**1)
+
+
+def score_quality(x: pd.Series) -> pd.Series:
+    """Score recordings for quality rating on the range zero to one"""
+    return x.map(QUALITY_SCORES).fillna(0.3).astype(float)
+
+
+def score_distance(x: np.ndarray) -> np.ndarray:
+    """Score recordings based on distance (closer is better) on the range zero to one"""
+    x = np.asarray(x, dtype=float)
+    return np.where(x > 5000, 0.0, 1 - (x/5000)**2)
+
+
+def make_session(pool_size: int = DOWNLOAD_WORKERS) -> requests.Session:
+    """Make a session that keeps up to `pool_size` connections alive per host for reuse across downloads"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def download_if_absent(url: str, filepath: str, session: requests.Session = None, retries: int = MAX_RETRIES,
+                       backoff: float = BACKOFF_SECONDS) -> bool:
     """Download file if absent, returning True if successful or file already present"""
     path = Path(filepath)
     if path.exists():
         return True
 
-    response = requests.get(url)
-
-    if response.status_code != 200:
-        print(f"Failed download to {path}. Status code: {response.status_code}")
-        return False
+    if session is None:
+        session = make_session(pool_size=1)
 
+    # Write to a partial file that is only renamed once complete, so an interrupted download is resumed rather
+    # than mistaken for a finished one
     path.parent.mkdir(parents=True, exist_ok=True)
-    with open(filepath, 'wb') as f:
-        f.write(response.content)
+    partial_path = path.with_name(path.name + ".part")
+
+    for attempt in range(retries + 1):
+        try:
+            if not download_to_partial(url, partial_path, session):
+                print(f"Failed download to {path}")
+                return False
+            os.replace(partial_path, path)
+            return True
+        except requests.RequestException as ex:
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+            print(f"Retrying download to {path} in {delay} seconds: {ex}")
+            time.sleep(delay)
+
+
+def download_to_partial(url: str, partial_path: Path, session: requests.Session) -> bool:
+    """Stream a download into a partial file, resuming from its current size with an HTTP range request"""
+    offset = partial_path.stat().st_size if partial_path.exists() else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+    item = partial_path.name.split(".")[0]
+    with instrument.span("download", "request", item=item, threaded=True) as record, \
+            session.get(url, headers=headers, stream=True, timeout=TIMEOUT_SECONDS) as response:
+        record["status"] = response.status_code
+        if response.status_code == 416:
+            # Nothing left to request means the partial file is already complete; otherwise start over
+            if response.headers.get("Content-Range") == f"bytes */{offset}":
+                return True
+            partial_path.unlink()
+            raise requests.HTTPError(f"Range not satisfiable for partial file of {offset} bytes", response=response)
+        if response.status_code == 429 or response.status_code >= 500:
+            raise requests.HTTPError(f"Status code: {response.status_code}", response=response)
+        if response.status_code not in (200, 206):
+            print(f"Status code: {response.status_code}")
+            return False
+
+        # A server that ignores the range request sends the whole file, which replaces the partial file
+        mode = "ab" if response.status_code == 206 else "wb"
+        received = 0
+        with open(partial_path, mode) as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+                received += len(chunk)
+        record["bytes_read"] = record["bytes_written"] = received
 
     return True
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DOWNLOAD_WORKERS,
+        help="Number of concurrent downloads"
+    )
+
+    parser.add_argument(
+        "--latitude",
+        type=float,
+        default=LATITUDE,
+        help="Latitude of the reference point used to prefer nearby recordings"
+    )
+    parser.add_argument(
+        "--longitude",
+        type=float,
+        default=LONGITUDE,
+        help="Longitude of the reference point used to prefer nearby recordings"
+    )
+
+    instrument.add_arguments(parser, profile=False)
+
+    args = parser.parse_args()
+
+    instrument.configure(trace_path=args.trace)
+    main(workers=args.workers, latitude=args.latitude, longitude=args.longitude)
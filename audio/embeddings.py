@@ -0,0 +1,125 @@
+"""Store BirdNET embeddings of the analyzed clips and index the recordings and species that sound alike
+
+The store is a float32 .npy array with one row per recording, read memory-mapped, and a .json list of the recording
+id of each row. The index is built from the store for the recordings in the app data and saved as a .npz file of
+integer arrays, numbering recordings consecutively by species in app data order as the app does.
+"""
+import argparse
+import json
+import numpy as np
+from audio import storage
+
+
+EMBEDDINGS_PATH = storage.DATA_DIR / "embeddings.npy"
+EMBEDDING_IDS_PATH = storage.DATA_DIR / "embedding_ids.json"
+INDEX_PATH = storage.DATA_DIR / "similarity_index.npz"
+CONFUSABLE_SPECIES = 5  # Species most alike each species that hard questions pair it with
+SIMILAR_RECORDINGS = 3  # Recordings most alike a recording that hard questions choose among
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """Scale rows to unit length so that dot products are cosine similarities, leaving zero rows as they are"""
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return (vectors / np.where(norms > 0, norms, 1)).astype(np.float32)
+
+
+def write_store(embeddings: dict) -> None:
+    """Write embeddings by recording id to the memory-mapped store, replacing its contents"""
+    ids = sorted(embeddings)
+    dimension = len(next(iter(embeddings.values()))) if ids else 0
+    tmp_path = EMBEDDINGS_PATH.with_suffix(".tmp.npy")
+    store = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(len(ids), dimension))
+    for row, recording_id in enumerate(ids):
+        store[row] = embeddings[recording_id]
+    store.flush()
+    del store
+    tmp_path.replace(EMBEDDINGS_PATH)
+    with open(EMBEDDING_IDS_PATH, "w") as file:
+        json.dump(ids, file)
+    print("Wrote embeddings for", len(ids), "recordings:", EMBEDDINGS_PATH)
+
+
+def read_store() -> tuple:
+    """The recording ids of the store and its embeddings, memory-mapped rather than read"""
+    with open(EMBEDDING_IDS_PATH) as file:
+        ids = json.load(file)
+    return ids, np.load(EMBEDDINGS_PATH, mmap_mode="r")
+
+
+def build_index(recordings_by_species: dict, embeddings: np.ndarray, confusable: int = CONFUSABLE_SPECIES,
+                similar: int = SIMILAR_RECORDINGS) -> dict:
+    """Find the species most alike each species, and the recordings of those species most alike each recording"""
+    # Everything is exact: each species is compared with every other by its mean embedding, and each recording only
+    # with the recordings of its own species and of the species most alike its own
+    counts = np.array([len(records) for records in recordings_by_species.values()], dtype=np.int64)
+    offsets = np.cumsum(counts) - counts
+    vectors = normalize(np.asarray(embeddings, dtype=np.float32))
+
+    centroids = normalize(np.array([vectors[o:o + c].sum(axis=0) for o, c in zip(offsets, counts)]))
+    species_similarity = centroids @ centroids.T
+    np.fill_diagonal(species_similarity, -np.inf)
+    species_similarity[:, counts == 0] = -np.inf
+    confusable = min(confusable, np.count_nonzero(counts) - 1)
+    neighbours = np.argsort(-species_similarity, axis=1, kind="stable")[:, :confusable]
+
+    similar_recordings = np.empty((len(vectors), confusable, similar), dtype=np.int64)
+    same_species = np.empty((len(vectors), similar), dtype=np.int64)
+    for s, (offset, count) in enumerate(zip(offsets, counts)):
+        if count == 0:
+            continue
+        block = vectors[offset:offset + count]
+        for j, t in enumerate(neighbours[s]):
+            candidates = vectors[offsets[t]:offsets[t] + counts[t]]
+            similar_recordings[offset:offset + count, j] = offsets[t] + nearest(block, candidates, similar)
+        within = block @ block.T
+        np.fill_diagonal(within, -np.inf)
+        # A species' only recording is its own nearest; such species are never drawn as the paired bird
+        same_species[offset:offset + count] = offset + nearest_by_similarity(within, similar, exclude_self=count > 1)
+
+    return {
+        "recording_ids": np.array([r["recording_id"] for records in recordings_by_species.values() for r in records]),
+        "neighbours": neighbours,
+        "similar_recordings": similar_recordings,
+        "same_species": same_species,
+    }
+
+
+def nearest(queries: np.ndarray, candidates: np.ndarray, k: int) -> np.ndarray:
+    """Positions of the k candidates most alike each query, repeating the nearest where there are fewer than k"""
+    return nearest_by_similarity(queries @ candidates.T, k)
+
+
+def nearest_by_similarity(similarity: np.ndarray, k: int, exclude_self: bool = False) -> np.ndarray:
+    """Positions of the k largest similarities in each row, cycling through them where a row has fewer than k"""
+    n = similarity.shape[1] - (1 if exclude_self else 0)
+    order = np.argsort(-similarity, axis=1, kind="stable")[:, :max(n, 1)]
+    return order[:, np.arange(k) % order.shape[1]]
+
+
+def write_index(recordings_by_species: dict) -> bool:
+    """Build the similarity index for the app data from the store, returning whether every recording had an embedding"""
+    if not EMBEDDINGS_PATH.exists():
+        print("No embeddings to index:", EMBEDDINGS_PATH)
+        return False
+    ids, store = read_store()
+    rows = {recording_id: row for row, recording_id in enumerate(ids)}
+    wanted = [r["recording_id"] for records in recordings_by_species.values() for r in records]
+    missing = [recording_id for recording_id in wanted if recording_id not in rows]
+    if missing:
+        print("Not building the similarity index, as", len(missing), "recordings have no embedding, e.g.", missing[:5])
+        return False
+
+    index = build_index(recordings_by_species, store[[rows[recording_id] for recording_id in wanted]])
+    tmp_path = INDEX_PATH.with_suffix(".tmp.npz")
+    np.savez(tmp_path, **index)
+    tmp_path.replace(INDEX_PATH)
+    print("Wrote similarity index for", len(wanted), "recordings:", INDEX_PATH)
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the similarity index for the app data from the embeddings")
+
+    args = parser.parse_args()
+
+    write_index(storage.read_app_data())
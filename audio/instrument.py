@@ -0,0 +1,152 @@
+import argparse
+import contextvars
+import cProfile
+import json
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+import pandas as pd
+
+
+BASE_DIR = Path(__file__).resolve().parent
+PROFILE_DIR = BASE_DIR / "data" / "profiles"
+
+# Settings are passed through the environment so that worker processes started by the scripts inherit them
+TRACE_ENV = "PHOEBE_TRACE"  # Path of a .jsonl file that a record is appended to for every step
+PROFILE_ENV = "PHOEBE_PROFILE"  # Comma-separated ids of recordings to profile with cProfile
+
+_current_item = contextvars.ContextVar("current_item", default=None)
+_overhead = {"read": 0, "written": 0}  # Bytes this module read and wrote itself, left out of the counts it reports
+
+
+def configure(trace_path: str | None = None, profile: list | None = None) -> None:
+    """Enable tracing and profiling for this process and any worker processes it starts"""
+    if trace_path is not None:
+        os.environ[TRACE_ENV] = str(Path(trace_path).resolve())
+    if profile:
+        os.environ[PROFILE_ENV] = ",".join(profile)
+
+
+def io_counters() -> tuple:
+    """Bytes read and written by this process so far, or None where the platform does not report them"""
+    try:
+        with open("/proc/self/io") as file:
+            text = file.read()
+        counters = dict(line.split(": ") for line in text.splitlines())
+        read = int(counters["rchar"]) - _overhead["read"]
+        written = int(counters["wchar"]) - _overhead["written"]
+        # The counters are read before this read of them is counted, so leave it out of the next reading instead
+        _overhead["read"] += len(text)
+        return read, written
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+@contextmanager
+def span(stage: str, step: str, item: str | None = None, threaded: bool = False):
+    """Record wall time, CPU time and bytes read and written for a step of a stage, if tracing is enabled"""
+    # Steps nested within a span for an item are recorded against the same item. CPU time and bytes are otherwise
+    # counted for the whole process, so threaded steps count CPU time for their thread only and set "bytes_read"
+    # and "bytes_written" on the record themselves.
+    token = _current_item.set(str(item)) if item is not None else None
+    path = os.environ.get(TRACE_ENV)
+    record = {"stage": stage, "step": step, "item": _current_item.get()}
+    if not path:
+        try:
+            yield record
+        finally:
+            if token is not None:
+                _current_item.reset(token)
+        return
+
+    timestamp = time.time()
+    wall = time.perf_counter()
+    cpu_time = time.thread_time if threaded else time.process_time
+    cpu = cpu_time()
+    read, written = (None, None) if threaded else io_counters()
+    try:
+        yield record
+    except BaseException as ex:
+        record["error"] = type(ex).__name__
+        raise
+    finally:
+        if token is not None:
+            _current_item.reset(token)
+        end_read, end_written = (None, None) if threaded else io_counters()
+        record["pid"] = os.getpid()
+        record["timestamp"] = timestamp
+        record["wall_s"] = time.perf_counter() - wall
+        record["cpu_s"] = cpu_time() - cpu
+        if read is not None:
+            record.setdefault("bytes_read", end_read - read)
+            record.setdefault("bytes_written", end_written - written)
+        # Each record is a single short append, so records from concurrent processes do not interleave
+        line = json.dumps(record, default=str) + "\n"
+        with open(path, "a") as file:
+            file.write(line)
+        _overhead["written"] += len(line)
+
+
+@contextmanager
+def profile(stage: str, item: str):
+    """Profile a block with cProfile if its item was selected, writing stats to the profiles directory"""
+    if str(item) not in os.environ.get(PROFILE_ENV, "").split(","):
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        path = PROFILE_DIR / f"{stage}-{item}.prof"
+        profiler.dump_stats(path)
+        print("Wrote profile:", path)
+
+
+def add_arguments(parser: argparse.ArgumentParser, profile: bool = True) -> None:
+    """Add the tracing and profiling options shared by the scripts"""
+    parser.add_argument(
+        "--trace",
+        default=None,
+        help="Append wall time, CPU time and bytes read and written for every step to this .jsonl file"
+    )
+    if not profile:
+        return
+    parser.add_argument(
+        "--profile",
+        nargs="+",
+        default=None,
+        help="Ids of recordings to profile with cProfile, writing .prof files to data/profiles"
+    )
+
+
+def summarize(path: str) -> pd.DataFrame:
+    """Total and slowest times and bytes for each step in a trace, slowest steps first"""
+    trace = pd.read_json(path, lines=True)
+    for column in ["bytes_read", "bytes_written"]:
+        if column not in trace.columns:
+            trace[column] = float("nan")
+    summary = trace.groupby(["stage", "step"]).agg(
+        count=("wall_s", "size"),
+        wall_s=("wall_s", "sum"),
+        cpu_s=("cpu_s", "sum"),
+        max_wall_s=("wall_s", "max"),
+        bytes_read=("bytes_read", "sum"),
+        bytes_written=("bytes_written", "sum"),
+    )
+    slowest = trace.loc[trace.groupby(["stage", "step"])["wall_s"].idxmax(), ["stage", "step", "item"]]
+    summary["slowest_item"] = slowest.set_index(["stage", "step"])["item"]
+    return summary.sort_values("wall_s", ascending=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trace", help="Path of a .jsonl trace written by one of the scripts")
+
+    args = parser.parse_args()
+
+    print(summarize(args.trace).to_markdown(floatfmt=".2f"))
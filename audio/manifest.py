@@ -1,69 +1,244 @@
+import argparse
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from urllib.parse import urlparse
 import requests
 import pandas as pd
 from pathlib import Path
 from dotenv import load_dotenv
 import os
+from audio import instrument, storage
 
 
 load_dotenv()
 API_KEY = os.getenv("XENOCANTO_API_KEY")
+XENOCANTO_URL = os.getenv("XENOCANTO_URL", "https://xeno-canto.org/api/3/recordings")
 
 BASE_DIR = Path(__file__).resolve().parent
-MANIFEST_PATH = BASE_DIR / "data" / "manifest.csv"
+SYNC_PATH = BASE_DIR / "data" / "manifest_sync.json"
 SCIENTIFIC_NAMES_PATH = BASE_DIR / "scientific_names.txt"
+RESPONSE_CACHE_DIR = BASE_DIR / "data" / "xenocanto_cache"
 
+REQUEST_WORKERS = 4
+SYNC_INTERVAL_DAYS = 7  # Days after a species' last sync that the pipeline updates its records again
+REQUESTS_PER_SECOND = 1.0
 
-def main():
+
+class HostRateLimiter:
+    """Thread-safe limit on how often requests may be started to each host"""
+
+    def __init__(self, requests_per_second: float):
+        self.interval = 1 / requests_per_second
+        self._next_start = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url: str) -> None:
+        """Block until a request to the url's host is allowed, reserving the next slot for this caller"""
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start.get(host, now))
+            self._next_start[host] = start + self.interval
+        time.sleep(start - now)
+
+
+RATE_LIMITER = HostRateLimiter(REQUESTS_PER_SECOND)
+SESSION = requests.Session()
+
+
+def main(workers: int = REQUEST_WORKERS, update: bool = False):
     with open(SCIENTIFIC_NAMES_PATH) as f:
         scientific_names = f.read().splitlines()
-    manifest_df = manifest_xenocanto_all(scientific_names)
-    manifest_df.to_csv(MANIFEST_PATH)
-    print("Wrote manifest:", MANIFEST_PATH)
+    if update:
+        manifest_df, sync = update_xenocanto_all(scientific_names, workers=workers)
+        save_sync(sync)
+    else:
+        manifest_df = manifest_xenocanto_all(scientific_names, workers=workers)
+    path = storage.write_table(manifest_df, "manifest")
+    print("Wrote manifest:", path)
 
 
-def manifest_xenocanto_all(scientific_names: list) -> pd.DataFrame:
+def manifest_xenocanto_all(scientific_names: list, workers: int = REQUEST_WORKERS) -> pd.DataFrame:
     """Function to get records for all selected species"""
-    manifest_list = []
-    for name in scientific_names:
-        manifest_list.append(manifest_xenocanto_one_species(name, key=API_KEY))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        manifest_list = list(executor.map(
+            lambda name: manifest_xenocanto_one_species(name, key=API_KEY, workers=workers),
+            scientific_names
+        ))
 
     manifest_df = pd.concat(manifest_list, axis=0)
 
     return manifest_df
 
 
-def manifest_xenocanto_one_species(scientific_name: str, key: str) -> pd.DataFrame:
-    """Function to get all matching records for a species with pagination"""
+def manifest_xenocanto_one_species(scientific_name: str, key: str, workers: int = REQUEST_WORKERS,
+                                   since: str | None = None, refresh: bool = False) -> pd.DataFrame:
+    """Function to get all matching records for a species with pagination, optionally only those uploaded since a date"""
     query_params = [("sp", scientific_name)]
+    if since is not None:
+        query_params.append(("since", since))
 
+    # The first page is always requested fresh, and cached later pages are reused only if they were fetched when the
+    # query matched as many recordings, since pages shift as recordings are added
     print(scientific_name, "first request")
-    first_response = query_xenocanto(query_params, key=key, page=1)
-    first_data = first_response.json()
-    pages = first_data["numPages"]
+    first_data = query_xenocanto(query_params, key=key, page=1, refresh=True)
+    pages = int(first_data["numPages"])
+    counts = {"numRecordings": first_data["numRecordings"], "numPages": first_data["numPages"]}
 
-    recording_list = [first_data["recordings"]]
-    for p in range(2, pages + 1):
+    def fetch_page(p):
         print(scientific_name, "page", p, "of", pages)
-        response = query_xenocanto(query_params, key=key, page=p)
-        additional_recordings = response.json()['recordings']
-        recording_list.append(additional_recordings)
+        return query_xenocanto(query_params, key=key, page=p, refresh=refresh, expected=counts)["recordings"]
 
-    df = pd.concat(
-        [pd.DataFrame(data) for data in recording_list],
-        axis=0
-    )
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        recording_list = [first_data["recordings"]] + list(executor.map(fetch_page, range(2, pages + 1)))
+
+    recordings = [recording for data in recording_list for recording in data]
+    if not recordings:
+        return empty_manifest()
+
+    df = pd.DataFrame(recordings)
 
-    df = df.set_index("id")
+    # A recording can still appear on two pages if it was added between requests
+    df = df.drop_duplicates(subset="id").set_index("id")
 
     return df
 
 
-def query_xenocanto(query_params: list, key: str, per_page: int = 100, page: int = 1):
-    """Function to make request to Xeno-Canto"""
-    base_url = "https://xeno-canto.org/api/3/recordings"
+def update_xenocanto_all(scientific_names: list, workers: int = REQUEST_WORKERS) -> tuple:
+    """Function to update the existing manifest with changes since each species was last synced"""
+    existing = read_existing(scientific_names)
+    sync = load_sync()
+
+    def update(name):
+        last_sync = sync.get(name, {}).get("last_sync")
+        return update_xenocanto_one_species(name, existing.get(name, empty_manifest()), last_sync, key=API_KEY,
+                                            workers=workers)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(update, scientific_names))
+
+    # Species no longer listed are dropped along with their sync metadata
+    manifest_df = pd.concat([df for df, _ in results], axis=0)
+    new_sync = {name: entry for name, (_, entry) in zip(scientific_names, results)}
+
+    return manifest_df, new_sync
+
+
+def read_existing(scientific_names: list) -> dict:
+    """Function to read the stored manifest rows of the given species, by species, reading no others"""
+    if not storage.table_exists("manifest"):
+        return {}
+    existing = storage.read_table("manifest", species=scientific_names)
+    return dict(tuple(existing.groupby(storage.species_names("manifest", existing), sort=False)))
+
+
+def empty_manifest() -> pd.DataFrame:
+    return pd.DataFrame(index=pd.Index([], name="id", dtype=str))
+
+
+def update_xenocanto_one_species(scientific_name: str, existing: pd.DataFrame, last_sync: str | None, key: str,
+                                 workers: int = REQUEST_WORKERS) -> tuple:
+    """Function to merge recordings uploaded since the last sync into a species' records, re-crawling if they disagree"""
+    today = date.today().isoformat()
+
+    if last_sync is None or existing.empty:
+        df = manifest_xenocanto_one_species(scientific_name, key=key, workers=workers, refresh=True)
+        return df, {"last_sync": today, "num_recordings": len(df)}
+
+    # The first page of the full query is always requested fresh for the current number of recordings
+    first_data = query_xenocanto([("sp", scientific_name)], key=key, page=1, refresh=True)
+    expected = int(first_data["numRecordings"])
+
+    new = manifest_xenocanto_one_species(scientific_name, key=key, workers=workers, since=last_sync, refresh=True)
+    merged = pd.concat([existing.drop(new.index, errors="ignore"), new], axis=0)
+
+    # A count that does not add up means recordings were retracted, so fetch the species' records again in full
+    if len(merged) != expected:
+        print(scientific_name, "has", expected, "recordings but", len(merged), "after merging, re-crawling")
+        merged = manifest_xenocanto_one_species(scientific_name, key=key, workers=workers, refresh=True)
+
+    return merged, {"last_sync": today, "num_recordings": len(merged)}
+
+
+def load_sync() -> dict:
+    """Function to read per-species sync metadata, which is empty before the first update"""
+    if not SYNC_PATH.exists():
+        return {}
+    with open(SYNC_PATH) as file:
+        return json.load(file)
+
+
+def sync_due(entry: dict | None) -> bool:
+    """Function to tell whether a species with the given sync metadata has never been synced or is due an update"""
+    if entry is None or entry.get("last_sync") is None:
+        return True
+    return date.fromisoformat(entry["last_sync"]) + timedelta(days=SYNC_INTERVAL_DAYS) <= date.today()
+
+
+def save_sync(sync: dict) -> None:
+    """Function to write per-species sync metadata"""
+    with open(SYNC_PATH, "w") as file:
+        json.dump(sync, file, indent=4)
+
+
+def query_xenocanto(query_params: list, key: str, per_page: int = 100, page: int = 1, refresh: bool = False,
+                    base_url: str = XENOCANTO_URL, cache_dir: Path = RESPONSE_CACHE_DIR,
+                    expected: dict | None = None) -> dict:
+    """Function to make request to Xeno-Canto, using the on-disk cache of responses unless `refresh` is set or the
+    cached response's values differ from those `expected`"""
     query_string = ' '.join([f'{key}:"{item}"' for key, item in query_params])
-    return requests.get(base_url, params={"query": query_string, "key": key, "per_page": per_page, "page": page})
+
+    # The API key is left out of the cache key so that responses remain valid if the key changes
+    cache_key = json.dumps({"url": base_url, "query": query_string, "per_page": per_page, "page": page})
+    cache_path = cache_dir / (hashlib.sha256(cache_key.encode()).hexdigest() + ".json")
+    item = f"{query_string} page {page}"
+    if cache_path.exists() and not refresh:
+        with instrument.span("manifest", "cached", item=item, threaded=True) as record, open(cache_path) as file:
+            record["bytes_read"], record["bytes_written"] = cache_path.stat().st_size, 0
+            data = json.load(file)
+        if all(str(data.get(field)) == str(value) for field, value in (expected or {}).items()):
+            return data
+
+    with instrument.span("manifest", "rate_limit", item=item, threaded=True):
+        RATE_LIMITER.wait(base_url)
+    with instrument.span("manifest", "request", item=item, threaded=True) as record:
+        response = SESSION.get(base_url, params={"query": query_string, "key": key, "per_page": per_page, "page": page})
+        response.raise_for_status()
+        data = response.json()
+        record["bytes_read"], record["bytes_written"] = len(response.content), 0
+
+    # Write to a temporary file first so that an interrupted run never leaves a partial response in the cache
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as file:
+        json.dump(data, file)
+    os.replace(tmp_path, cache_path)
+
+    return data
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=REQUEST_WORKERS,
+        help="Number of concurrent requests to Xeno-Canto, which are also subject to a rate limit"
+    )
+
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        help="Merge recordings uploaded since the last sync into the existing manifest instead of rebuilding it"
+    )
+
+    instrument.add_arguments(parser, profile=False)
+
+    args = parser.parse_args()
+
+    instrument.configure(trace_path=args.trace)
+    main(workers=args.workers, update=args.update)
@@ -0,0 +1,266 @@
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from graphlib import TopologicalSorter
+from pathlib import Path
+from typing import Callable
+import pandas as pd
+from audio import analyze, download, embeddings, instrument, manifest, process, storage
+from phoebe import data as catalogue
+
+
+STATE_PATH = storage.DATA_DIR / "pipeline_state.json"
+
+
+@dataclass
+class Stage:
+    """A pipeline stage whose work is split into partitions that can be rebuilt independently
+
+    `fingerprints` maps each partition to a hash of everything its output depends on, `build` rebuilds the given
+    partitions and returns any that failed, and `output_exists` reports whether the stage has output to keep.
+    """
+    name: str
+    deps: tuple
+    fingerprints: Callable
+    build: Callable
+    output_exists: Callable
+
+
+def main(stages: list | None = None, jobs: int = 1, force: bool = False) -> None:
+    """Run the pipeline stages in dependency order, rebuilding only partitions whose inputs changed"""
+    state = load_state()
+    context = {"jobs": jobs, "force": force, "digests": state.setdefault("digests", {})}
+    order = list(TopologicalSorter({stage.name: stage.deps for stage in STAGES.values()}).static_order())
+
+    summary = []
+    for name in order:
+        if stages is not None and name not in stages:
+            continue
+        stage = STAGES[name]
+        tic = time.perf_counter()
+
+        with instrument.span("pipeline", "fingerprint", item=name):
+            fingerprints = stage.fingerprints(context)
+        previous = {} if force or not stage.output_exists() else state["stages"].get(name, {})
+        dirty = [p for p, fp in fingerprints.items() if previous.get(p) != fp]
+        removed = set(previous) - set(fingerprints)
+
+        failed = []
+        if dirty or removed:
+            print(f"{name}: rebuilding {len(dirty)} of {len(fingerprints)} partitions")
+            with instrument.span("pipeline", "build", item=name):
+                failed = stage.build(dirty, fingerprints, context)
+            # Building can change a stage's own inputs (downloaded files, for example), so fingerprint again
+            fingerprints = stage.fingerprints(context)
+        else:
+            print(f"{name}: up to date")
+
+        state["stages"][name] = {p: fp for p, fp in fingerprints.items() if p not in failed}
+        save_state(state)
+        summary.append((name, len(fingerprints), len(dirty), len(failed), time.perf_counter() - tic))
+
+    print_summary(summary)
+
+
+def print_summary(summary: list) -> None:
+    """Print partition counts and wall time for each stage that ran"""
+    print(f"{'stage':<10}{'partitions':>12}{'rebuilt':>10}{'failed':>8}{'seconds':>10}")
+    for name, total, rebuilt, failed, seconds in summary:
+        print(f"{name:<10}{total:>12}{rebuilt:>10}{failed:>8}{seconds:>10.1f}")
+
+
+def fingerprint(value) -> str:
+    """Hash a JSON-serializable value"""
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def load_state() -> dict:
+    """Read the fingerprints recorded by the last run, which are empty before the first run"""
+    if not STATE_PATH.exists():
+        return {"stages": {}, "digests": {}}
+    with open(STATE_PATH) as file:
+        return json.load(file)
+
+
+def save_state(state: dict) -> None:
+    """Write the recorded fingerprints, replacing the previous file only once the new one is complete"""
+    tmp_path = STATE_PATH.with_suffix(".tmp")
+    with open(tmp_path, "w") as file:
+        json.dump(state, file)
+    os.replace(tmp_path, STATE_PATH)
+
+
+def file_digests(files: list, memo: dict, jobs: int = 1) -> dict:
+    """Content hashes of files, reusing those recorded for files whose size and modification time are unchanged"""
+    def digest(path):
+        stat = path.stat()
+        entry = memo.get(str(path))
+        if entry is not None and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return entry[2]
+        value = analyze.file_digest(path)
+        memo[str(path)] = [stat.st_size, stat.st_mtime_ns, value]
+        return value
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return dict(zip(files, executor.map(digest, files)))
+
+
+def file_stat(path: Path) -> list | None:
+    """Size and modification time of a file, or None if it does not exist"""
+    if not path.exists():
+        return None
+    stat = path.stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+# Manifest: one partition per species listed in scientific_names.txt
+
+def read_scientific_names() -> list:
+    with open(manifest.SCIENTIFIC_NAMES_PATH) as f:
+        return f.read().splitlines()
+
+
+def manifest_fingerprints(context: dict) -> dict:
+    # A species is rebuilt once its records are due an update, after which its new sync date changes the fingerprint
+    sync = manifest.load_sync()
+    return {
+        name: fingerprint({
+            "species": name,
+            "url": manifest.XENOCANTO_URL,
+            "last_sync": sync.get(name, {}).get("last_sync"),
+            "due": manifest.sync_due(sync.get(name)),
+        })
+        for name in read_scientific_names()
+    }
+
+
+def build_manifest(dirty: list, fingerprints: dict, context: dict) -> list:
+    existing = manifest.read_existing(list(fingerprints))
+    sync = manifest.load_sync()
+
+    # Merge recordings uploaded since each species' last sync, or crawl it in full if it was never synced or when forced
+    def update(name):
+        last_sync = None if context["force"] else sync.get(name, {}).get("last_sync")
+        return manifest.update_xenocanto_one_species(name, existing.get(name, manifest.empty_manifest()), last_sync,
+                                                     key=manifest.API_KEY, workers=context["jobs"])
+
+    with ThreadPoolExecutor(max_workers=context["jobs"]) as executor:
+        updated = dict(zip(dirty, executor.map(update, dirty)))
+
+    # Keep the rows of unchanged species, and drop species that are no longer listed along with their sync metadata
+    parts = [
+        updated[name][0] if name in updated else existing.get(name, manifest.empty_manifest()) for name in fingerprints
+    ]
+    storage.write_table(pd.concat(parts, axis=0), "manifest")
+    manifest.save_sync({
+        name: updated[name][1] if name in updated else sync[name]
+        for name in fingerprints if name in updated or name in sync
+    })
+    return []
+
+
+# Download: one partition per species, covering its selected recordings and whether they are present
+
+def download_selection() -> pd.DataFrame:
+    return download.select_recordings(storage.read_table("manifest", columns=download.MANIFEST_COLUMNS))
+
+
+def download_fingerprints(context: dict) -> dict:
+    selection = download_selection()
+    species = storage.species_names("manifest", selection)
+    return {
+        name: fingerprint([
+            (idx, row["file"], file_stat(download.RAW_PATH / (idx + ".mp3")))
+            for idx, row in selection.loc[species == name].iterrows()
+        ])
+        for name in species.drop_duplicates()
+    }
+
+
+def build_download(dirty: list, fingerprints: dict, context: dict) -> list:
+    selection = download_selection()
+    species = storage.species_names("manifest", selection)
+    failed_ids = download.download_recordings(selection.loc[species.isin(dirty)], workers=context["jobs"])
+    return list(species.loc[failed_ids].drop_duplicates())
+
+
+# Analyze: one partition per raw recording, fingerprinted by the key of its result in the analysis cache
+
+def analyze_tasks(context: dict) -> list:
+    manifest = storage.read_table("manifest", columns=analyze.MANIFEST_COLUMNS)
+    files = analyze.recorded_files(manifest)
+    digests = file_digests(files, context["digests"], jobs=context["jobs"])
+    return analyze.build_tasks(files, manifest, digests)
+
+
+def analyze_fingerprints(context: dict) -> dict:
+    return {task["filepath"].stem: task["key"] for task in analyze_tasks(context)}
+
+
+def build_analyze(dirty: list, fingerprints: dict, context: dict) -> list:
+    # Results for unchanged recordings come from the analysis cache, so only changed recordings are analyzed
+    tasks = analyze_tasks(context)
+    results = analyze.analyze_tasks(tasks, workers=context["jobs"])
+    analyze.write_analysis([task["filepath"] for task in tasks], results)
+    return [task["filepath"].stem for task in tasks if task["filepath"].stem not in results]
+
+
+# Process: one partition per species, covering its ranked candidates and their metadata and raw files
+
+def process_inputs() -> tuple:
+    manifest_df = storage.read_table("manifest", columns=process.MANIFEST_COLUMNS)
+    analysis = process.sort_analysis_dataframe(storage.read_table("analysis"))
+    return manifest_df, analysis, process.species_candidates(analysis)
+
+
+def process_fingerprints(context: dict) -> dict:
+    manifest_df, analysis, candidates = process_inputs()
+    return {
+        sn: fingerprint({
+            "recordings_per_bird": process.RECORDINGS_PER_BIRD,
+            "candidates": [
+                (idx, analysis.loc[idx, "start"], analysis.loc[idx, "end"], list(manifest_df.loc[idx]),
+                 file_stat(process.RAW_DIR / (idx + ".mp3")))
+                for idx in ids
+            ],
+        })
+        for sn, ids in candidates.items()
+    }
+
+
+def build_process(dirty: list, fingerprints: dict, context: dict) -> list:
+    manifest_df, analysis, candidates = process_inputs()
+    dirty_candidates = {sn: candidates[sn] for sn in dirty}
+    if context["jobs"] <= 1:
+        selected = process.clip_candidates_serial(analysis, dirty_candidates)
+    else:
+        selected = process.clip_candidates_parallel(analysis, dirty_candidates, workers=context["jobs"])
+
+    # Keep app data for unchanged species, in the same species order as a full run
+    rebuilt = process.build_app_data(selected, analysis, manifest_df)
+    existing = storage.read_app_data() if storage.APP_DATA_PATH.exists() else {}
+    app_data = {}
+    for sn in candidates:
+        recordings = rebuilt.get(sn, []) if sn in dirty_candidates else existing.get(sn, [])
+        if recordings:
+            app_data[sn] = recordings
+
+    storage.write_app_data(app_data)
+    process.write_license_markdown(app_data)
+    catalogue.write_snapshot()
+    process.write_static_assets(app_data)
+    embeddings.write_index(app_data)
+    return []
+
+
+STAGES = {
+    stage.name: stage for stage in [
+        Stage("manifest", (), manifest_fingerprints, build_manifest, lambda: storage.table_exists("manifest")),
+        Stage("download", ("manifest",), download_fingerprints, build_download, download.RAW_PATH.exists),
+        Stage("analyze", ("download",), analyze_fingerprints, build_analyze, lambda: storage.table_exists("analysis")),
+        Stage("process", ("analyze",), process_fingerprints, build_process, storage.APP_DATA_PATH.exists),
+    ]
+}
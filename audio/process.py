@@ -1,69 +1,215 @@
+import argparse
+import hashlib
 import json
+import mmap
+import shutil
+from urllib.parse import quote
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 import pandas as pd
 from pathlib import Path
-from pydub import AudioSegment
 from collections import defaultdict
+from audio import embeddings, instrument, storage
+from phoebe import data as catalogue
 
 
 BASE_DIR = Path(__file__).resolve().parent
 RAW_DIR = BASE_DIR / "data" / "raw"
 PROCESSED_DIR = BASE_DIR / "data" / "processed"
-MANIFEST_PATH = BASE_DIR / "data" / "manifest.csv"
-ANALYSIS_PATH = BASE_DIR / "data" / "analysis.csv"
-APP_DATA_PATH = BASE_DIR / "data" / "app_data.json"
+MANIFEST_COLUMNS = ["en", "rec", "lic", "url"]
 LICENSE_MARKDOWN_PATH = BASE_DIR / "data" / "licenses.md"
 RECORDINGS_PER_BIRD = 10
 
+# Processed audio and bird images are copied under content-hashed names to the folder Streamlit serves at /app/static
+# when `server.enableStaticServing` is set, or that can be uploaded to any static host. A file's name changes whenever
+# its contents do, so it can be cached for good.
+BIRD_IMAGE_DIR = BASE_DIR.parent / "images" / "data" / "birds"
+STATIC_DIR = BASE_DIR.parent / "static"
+STATIC_MANIFEST_PATH = BASE_DIR / "data" / "static_manifest.json"
 
-def main():
-    manifest = pd.read_csv(MANIFEST_PATH, index_col="id", dtype={"id": str})
-    analysis = pd.read_csv(ANALYSIS_PATH, index_col="id", dtype={"id": str})
+# MPEG audio frame header tables, indexed by the version and layer bits of the header
+MPEG1, MPEG2, MPEG25 = 3, 2, 0
+LAYER1, LAYER2, LAYER3 = 3, 2, 1
+BITRATES_KBPS = {
+    (MPEG1, LAYER1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (MPEG1, LAYER2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (MPEG1, LAYER3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (MPEG2, LAYER1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (MPEG2, LAYER2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (MPEG2, LAYER3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+SAMPLE_RATES = {MPEG1: [44100, 48000, 32000], MPEG2: [22050, 24000, 16000], MPEG25: [11025, 12000, 8000]}
+MONO = 3  # Channel mode bits of a single channel frame
+
+# Layout of the Xing/Info frame written at the start of each clip, with a LAME extension giving the encoder delay
+XING_FRAMES, XING_BYTES, XING_TOC, XING_QUALITY = 1, 2, 4, 8
+LAME_ENCODER = b"LAME3.100"
+LAME_TAG_LENGTH = 36
+LAME_MAX_DELAY = 4095  # Largest encoder delay in samples, held in 12 bits of the LAME tag
+
+
+def main(workers: int = 1):
+    manifest = storage.read_table("manifest", columns=MANIFEST_COLUMNS)
+    analysis = storage.read_table("analysis")
     analysis = sort_analysis_dataframe(analysis)
 
+    candidates = species_candidates(analysis)
+    if workers <= 1:
+        selected = clip_candidates_serial(analysis, candidates)
+    else:
+        selected = clip_candidates_parallel(analysis, candidates, workers=workers)
+
+    with instrument.span("process", "app_data"):
+        app_data = build_app_data(selected, analysis, manifest)
+        storage.write_app_data(app_data)
+        write_license_markdown(app_data)
+        catalogue.write_snapshot()
+    with instrument.span("process", "static_assets"):
+        write_static_assets(app_data)
+    with instrument.span("process", "similarity_index"):
+        embeddings.write_index(app_data)
+
+
+def species_candidates(analysis: pd.DataFrame) -> dict:
+    """Recording ids for each species, in the order of a sorted analysis dataframe"""
+    return {
+        sn: list(analysis.index[analysis['scientific_name'] == sn])
+        for sn in analysis['scientific_name'].drop_duplicates()
+    }
+
+
+def build_app_data(selected: dict, analysis: pd.DataFrame, manifest: pd.DataFrame) -> dict:
+    """Collect app metadata for the selected recordings of each species"""
     app_data = defaultdict(list)
-    for sn in analysis['scientific_name'].drop_duplicates():
-        counter = 0
-        for idx, analysis_row in analysis.loc[analysis['scientific_name'] == sn].iterrows():
+    for sn, ids in selected.items():
+        for idx in ids:
+            analysis_row = analysis.loc[idx]
             manifest_row = manifest.loc[idx]
-            file_name = idx + ".mp3"
-            input_path = RAW_DIR / file_name
-            output_path = PROCESSED_DIR / file_name
+            # Record metadata
+            app_data[sn].append({
+                "recording_id": idx,
+                "scientific_name": analysis_row["scientific_name"],
+                "common_name": manifest_row["en"],
+                "author": manifest_row["rec"],
+                "license": manifest_row["lic"],
+                "url": manifest_row["url"],
+                "file_name": idx + ".mp3",
+                "start_sec": analysis_row["start"],
+                "end_sec": analysis_row["end"],
+            })
+    return app_data
 
-            try:
-                # Clip the audio file and write
+
+def clip_candidate(idx: str, start_sec: float, end_sec: float) -> None:
+    """Clip one recording and check the result, removing the output if either step fails"""
+    file_name = idx + ".mp3"
+    output_path = PROCESSED_DIR / file_name
+    try:
+        with instrument.span("process", "clip", item=idx), instrument.profile("process", idx):
+            # Clip the audio file and write
+            with instrument.span("process", "clip_mp3") as record:
                 clip_mp3(
-                    input_path=input_path,
+                    input_path=RAW_DIR / file_name,
                     output_path=output_path,
-                    start_sec=analysis_row["start"],
-                    end_sec=analysis_row["end"]
+                    start_sec=start_sec,
+                    end_sec=end_sec
                 )
-                # Test file can be loaded and has appropriate duration
-                validate_audio_file(output_path, analysis_row["end"] - analysis_row["start"])
-                # Record metadata
-                app_data[sn].append({
-                    "recording_id": idx,
-                    "scientific_name": analysis_row["scientific_name"],
-                    "common_name": manifest_row["en"],
-                    "author": manifest_row["rec"],
-                    "license": manifest_row["lic"],
-                    "url": manifest_row["url"],
-                    "file_name": idx + ".mp3",
-                    "start_sec": analysis_row["start"],
-                    "end_sec": analysis_row["end"],
-                })
+                # Input is memory-mapped rather than read, so is not counted as bytes read
+                record["bytes_read"] = (RAW_DIR / file_name).stat().st_size
+            # Test file can be loaded and has appropriate duration
+            with instrument.span("process", "validate"):
+                validate_audio_file(output_path, end_sec - start_sec)
+    except Exception:
+        output_path.unlink(missing_ok=True)
+        raise
+
+
+def clip_candidates_serial(analysis: pd.DataFrame, candidates: dict) -> dict:
+    """Clip each species' candidates in rank order until enough succeed, returning the selected ids by species"""
+    selected = {}
+    for sn, ids in candidates.items():
+        selected[sn] = []
+        for idx in ids:
+            try:
+                clip_candidate(idx, analysis.loc[idx, "start"], analysis.loc[idx, "end"])
                 print("Processed", idx, sn)
-                counter += 1
+                selected[sn].append(idx)
             except Exception as ex:
-                output_path.unlink(missing_ok=True)
                 print("Error processing", idx, sn, ":", ex)
 
-            if counter >= RECORDINGS_PER_BIRD:
+            if len(selected[sn]) >= RECORDINGS_PER_BIRD:
                 break
+    return selected
+
+
+def clip_candidates_parallel(analysis: pd.DataFrame, candidates: dict, workers: int) -> dict:
+    """Clip candidates for all species at once, selecting the same recordings as `clip_candidates_serial`"""
+    # Only as many candidates per species are in flight as could still be needed. Once the top-ranked candidates of
+    # a species are all resolved and include enough successes, its outstanding work is cancelled and any surplus
+    # clips are removed.
+    outcomes = {sn: {} for sn in candidates}  # Rank position -> whether clipping succeeded
+    next_position = {sn: 0 for sn in candidates}
+    pending = {}  # Future -> (species, rank position)
+    selected = {}
 
-    with open(APP_DATA_PATH, "w") as file:
-        json.dump(app_data, file,  indent=4)
+    def submit_more(sn):
+        ids = candidates[sn]
+        in_flight = sum(1 for species, _ in pending.values() if species == sn)
+        successes = sum(outcomes[sn].values())
+        while successes + in_flight < RECORDINGS_PER_BIRD and next_position[sn] < len(ids):
+            idx = ids[next_position[sn]]
+            future = executor.submit(clip_candidate, idx, analysis.loc[idx, "start"], analysis.loc[idx, "end"])
+            pending[future] = (sn, next_position[sn])
+            next_position[sn] += 1
+            in_flight += 1
 
-    write_license_markdown(app_data)
+    def try_finish(sn):
+        # Walk the resolved prefix of candidates in rank order, as the serial loop would have
+        chosen = []
+        position = 0
+        while position in outcomes[sn] and len(chosen) < RECORDINGS_PER_BIRD:
+            if outcomes[sn][position]:
+                chosen.append(candidates[sn][position])
+            position += 1
+        exhausted = position == len(candidates[sn])
+        if len(chosen) < RECORDINGS_PER_BIRD and not exhausted:
+            return
+
+        selected[sn] = chosen
+        for future, (species, _) in list(pending.items()):
+            if species == sn and future.cancel():
+                del pending[future]
+        for later_position, succeeded in outcomes[sn].items():
+            if later_position >= position and succeeded:
+                (PROCESSED_DIR / (candidates[sn][later_position] + ".mp3")).unlink(missing_ok=True)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for sn in candidates:
+            submit_more(sn)
+            if not candidates[sn]:
+                selected[sn] = []
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                sn, position = pending.pop(future)
+                idx = candidates[sn][position]
+                if future.exception() is None:
+                    outcomes[sn][position] = True
+                    print("Processed", idx, sn)
+                else:
+                    outcomes[sn][position] = False
+                    print("Error processing", idx, sn, ":", future.exception())
+
+                if sn in selected:
+                    # Finished while this clip was already running, so it is surplus
+                    if outcomes[sn][position]:
+                        (PROCESSED_DIR / (idx + ".mp3")).unlink(missing_ok=True)
+                    continue
+                try_finish(sn)
+                if sn not in selected:
+                    submit_more(sn)
+
+    return {sn: selected[sn] for sn in candidates}
 
 
 def sort_analysis_dataframe(analysis: pd.DataFrame) -> pd.DataFrame:
@@ -74,22 +220,219 @@ def sort_analysis_dataframe(analysis: pd.DataFrame) -> pd.DataFrame:
 
 
 def clip_mp3(input_path: str, output_path: str, start_sec: float, end_sec: float) -> None:
-    """Clip an audio file saving a new copy"""
-    audio = AudioSegment.from_mp3(input_path)
-    clipped = audio[start_sec * 1000:end_sec * 1000]
+    """Clip an audio file saving a new copy, copying whole MP3 frames without decoding or re-encoding
+
+    The clip starts with a new Xing or Info frame giving its frame count, size and seek table, so that players show
+    the right duration, followed by the frames overlapping the span and any before them holding bit reservoir data.
+    """
+    with open(input_path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        frames = list(iter_mp3_frames(data))
+        if not frames:
+            raise ValueError(f"No MP3 frames found in {input_path}")
+
+        # Keep the frames that overlap the requested span
+        first, last = None, None
+        elapsed = 0.0
+        for i, (_, _, seconds) in enumerate(frames):
+            if first is None and elapsed + seconds > start_sec:
+                first = i
+            if elapsed < end_sec:
+                last = i
+            elapsed += seconds
+        if first is None or last < first:
+            raise ValueError(f"Clip from {start_sec} to {end_sec} is outside the {elapsed} seconds of audio")
+
+        # Layer III frames may take some of their audio data from the bit reservoir of earlier frames, so start early
+        # enough to include it. The Info frame written first tells decoders to skip those frames' samples.
+        priming = reservoir_frames(data, frames, first)
+        clip_frames = frames[first - priming:last + 1]
+        start_offset = clip_frames[0][0]
+        end_offset = frames[last][0] + frames[last][1]
+
+        path = Path(output_path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as output:
+            output.write(info_frame(data, clip_frames, priming))
+            output.write(data[start_offset:end_offset])
+
+
+def side_info_length(header: bytes) -> int:
+    """Length in bytes of the Layer III side information following a frame header, including any CRC"""
+    version = (header[1] >> 3) & 3
+    mono = header[3] >> 6 == MONO
+    length = (17 if mono else 32) if version == MPEG1 else (9 if mono else 17)
+    return length + (0 if header[1] & 1 else 2)
+
+
+def reservoir_frames(data, frames: list, first: int) -> int:
+    """Number of frames before `first` holding bit reservoir data that it needs, up to as many as the encoder delay of
+    a LAME tag can skip, or zero for other layers"""
+    offset = frames[first][0]
+    header = data[offset:offset + 4]
+    if (header[1] >> 1) & 3 != LAYER3:
+        return 0
+    crc = 0 if header[1] & 1 else 2
+    # main_data_begin counts back from the frame's side information over the audio data of earlier frames
+    side_info = data[offset + 4 + crc:offset + 6 + crc]
+    reservoir = (side_info[0] << 1 | side_info[1] >> 7) if (header[1] >> 3) & 3 == MPEG1 else side_info[0]
 
-    path = Path(output_path)
-    path.parent.mkdir(parents=True, exist_ok=True)
+    samples = 1152 if (header[1] >> 3) & 3 == MPEG1 else 576
+    n = 0
+    while reservoir > 0 and n < first and (n + 1) * samples <= LAME_MAX_DELAY:
+        n += 1
+        previous_offset, previous_length, _ = frames[first - n]
+        reservoir -= previous_length - 4 - side_info_length(data[previous_offset:previous_offset + 4])
+    return n
 
-    clipped.export(path, format="mp3")
+
+def info_frame(data, frames: list, priming: int) -> bytes:
+    """A Xing (variable bitrate) or Info (constant bitrate) frame describing the given frames, with LAME's encoder
+    delay set to skip the samples of the first `priming` frames"""
+    offset = frames[0][0]
+    header = bytes(data[offset:offset + 4])
+    if (header[1] >> 1) & 3 != LAYER3:
+        return b""
+    version = (header[1] >> 3) & 3
+    rate = SAMPLE_RATES[version][(header[2] >> 2) & 3]
+    samples = round(frames[0][2] * rate)
+    bitrates = {data[o + 2] >> 4 for o, _, _ in frames}
+
+    # The frame has no CRC, no padding and the smallest bitrate with room for the tags after the side information
+    xing_offset = 4 + side_info_length(header[:1] + bytes([header[1] | 1]) + header[2:])
+    crc_offset = xing_offset + 120 + LAME_TAG_LENGTH - 2
+    table = BITRATES_KBPS[(MPEG1 if version == MPEG1 else MPEG2, LAYER3)]
+    for bitrate_index in range(1, len(table)):
+        header = header[:1] + bytes([header[1] | 1, bitrate_index << 4 | header[2] & 0x0D, header[3]])
+        length, _ = parse_frame_header(header)
+        if length >= crc_offset + 2:
+            break
+
+    # The table of contents gives, for each percent of the duration, the position in the file as a 256th of its size
+    positions = [length]
+    for _, frame_length, _ in frames:
+        positions.append(positions[-1] + frame_length)
+    audio_bytes = positions[-1] - length
+    toc = bytes(min(255, positions[len(frames) * i // 100] * 256 // positions[-1]) for i in range(100))
+
+    frame = bytearray(length)
+    frame[:4] = header
+    frame[xing_offset:xing_offset + 120] = (
+        (b"Xing" if len(bitrates) > 1 else b"Info")
+        + (XING_FRAMES | XING_BYTES | XING_TOC | XING_QUALITY).to_bytes(4, "big")
+        + len(frames).to_bytes(4, "big")
+        + (length + audio_bytes).to_bytes(4, "big")
+        + toc
+        + (0).to_bytes(4, "big")
+    )
+    delay = priming * samples
+    lame = xing_offset + 120
+    frame[lame:lame + 9] = LAME_ENCODER
+    frame[lame + 21:lame + 24] = (delay << 12).to_bytes(3, "big")  # Encoder delay and, left at zero, padding
+    frame[lame + 28:lame + 32] = (length + audio_bytes).to_bytes(4, "big")
+    frame[crc_offset:crc_offset + 2] = crc16(frame[:crc_offset]).to_bytes(2, "big")
+    return bytes(frame)
+
+
+def crc16(data: bytes) -> int:
+    """CRC-16 as LAME computes it for its tag, with the polynomial 0x8005 reflected"""
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
 
 
 def validate_audio_file(path: Path, expected_seconds: float):
-    """Test that audio file has approximately the expected duration"""
-    audio = AudioSegment.from_file(path)
-    if abs(audio.duration_seconds - expected_seconds) > expected_seconds * .1:
+    """Test that audio file has approximately the expected duration, reading only MP3 frame headers"""
+    duration_seconds = mp3_duration(path)
+    if abs(duration_seconds - expected_seconds) > expected_seconds * .1:
         raise ValueError(
-            f"Audio duration of {audio.duration_seconds} differs substantially from expected {expected_seconds}.")
+            f"Audio duration of {duration_seconds} differs substantially from expected {expected_seconds}.")
+
+
+def mp3_duration(path: Path) -> float:
+    """Duration in seconds of an MP3 file, summed from its frame headers"""
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return sum(seconds for _, _, seconds in iter_mp3_frames(data))
+
+
+def iter_mp3_frames(data):
+    """Yield (offset, length, seconds) for each audio frame in MP3 data, skipping tags and VBR information frames"""
+    offset = id3v2_length(data)
+    end = len(data)
+    if end - offset >= 128 and data[end - 128:end - 125] == b"TAG":
+        end -= 128  # ID3v1 tag
+
+    first = True
+    previous_was_frame = True
+    while offset + 4 <= end:
+        header = parse_frame_header(data[offset:offset + 4])
+        # After anything that is not a frame, only accept a frame if another follows it, to avoid false syncs
+        if header is not None and not previous_was_frame:
+            following = offset + header[0]
+            if following + 4 <= end and parse_frame_header(data[following:following + 4]) is None:
+                header = None
+        if header is None:
+            next_sync = data.find(b"\xff", offset + 1, end)
+            if next_sync < 0:
+                break
+            offset = next_sync
+            previous_was_frame = False
+            continue
+
+        length, seconds = header
+        if offset + length > end:
+            break
+
+        # A Xing, Info or VBRI frame at the start holds metadata for the whole file rather than audio
+        is_info_frame = first and any(
+            data.find(tag, offset, offset + length) >= 0 for tag in (b"Xing", b"Info", b"VBRI")
+        )
+        if not is_info_frame:
+            yield offset, length, seconds
+
+        first = False
+        previous_was_frame = True
+        offset += length
+
+
+def parse_frame_header(header: bytes) -> tuple | None:
+    """Return (frame length in bytes, frame duration in seconds) for an MPEG audio frame header, or None if invalid"""
+    b0, b1, b2, _ = header
+    if b0 != 0xFF or b1 & 0xE0 != 0xE0:
+        return None
+
+    version = (b1 >> 3) & 3
+    layer = (b1 >> 1) & 3
+    bitrate_index = b2 >> 4
+    rate_index = (b2 >> 2) & 3
+    padding = (b2 >> 1) & 1
+    # Reserved values, and free format bitrates whose frame length cannot be read from the header
+    if version == 1 or layer == 0 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+
+    bitrate = BITRATES_KBPS[(MPEG1 if version == MPEG1 else MPEG2, layer)][bitrate_index] * 1000
+    rate = SAMPLE_RATES[version][rate_index]
+    if layer == LAYER1:
+        samples = 384
+        length = (12 * bitrate // rate + padding) * 4
+    else:
+        samples = 1152 if layer == LAYER2 or version == MPEG1 else 576
+        length = samples // 8 * bitrate // rate + padding
+
+    return length, samples / rate
+
+
+def id3v2_length(data) -> int:
+    """Length in bytes of an ID3v2 tag at the start of the data, or zero if there is none"""
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+    size = 0
+    for byte in data[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
 
 
 def write_license_markdown(app_data: dict):
@@ -116,5 +459,50 @@ def write_license_markdown(app_data: dict):
         file.write(no_indent)
 
 
+def write_static_assets(app_data: dict) -> dict:
+    """Copy processed audio and bird images to the static folder under content-hashed names, writing a manifest of
+    their URLs relative to the folder"""
+    sources = {
+        "audio": [PROCESSED_DIR / r["file_name"] for recordings in app_data.values() for r in recordings],
+        "images": sorted(BIRD_IMAGE_DIR.glob("*.jpg")),
+    }
+    manifest = {}
+    for kind, paths in sources.items():
+        directory = STATIC_DIR / kind
+        directory.mkdir(parents=True, exist_ok=True)
+        manifest[kind] = {}
+        current = set()
+        for path in paths:
+            digest = hashlib.sha256(path.read_bytes()).hexdigest()[:12]
+            hashed_name = f"{path.stem}.{digest}{path.suffix}"
+            if not (directory / hashed_name).exists():
+                shutil.copyfile(path, directory / hashed_name)
+            manifest[kind][path.name] = f"{kind}/{quote(hashed_name)}"
+            current.add(hashed_name)
+
+        # Remove copies of files that have since changed or were dropped
+        for path in directory.iterdir():
+            if path.name not in current:
+                path.unlink()
+
+    with open(STATIC_MANIFEST_PATH, "w") as file:
+        json.dump(manifest, file, indent=4)
+    print("Wrote", sum(len(urls) for urls in manifest.values()), "static assets to", STATIC_DIR)
+    return manifest
+
+
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes used to clip candidates for all species at once"
+    )
+
+    instrument.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    instrument.configure(trace_path=args.trace, profile=args.profile)
+    main(workers=args.workers)
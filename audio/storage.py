@@ -0,0 +1,182 @@
+import argparse
+import json
+import os
+import pandas as pd
+from pathlib import Path
+
+
+DATA_DIR = Path(__file__).resolve().parent / "data"
+APP_DATA_PATH = DATA_DIR / "app_data.json"
+
+# Tables are stored as .csv by default. Set PHOEBE_STORAGE_FORMAT=parquet to store them as .parquet instead, which
+# requires pyarrow.
+STORAGE_FORMAT = os.getenv("PHOEBE_STORAGE_FORMAT", "csv")
+FORMATS = ("csv", "parquet")
+
+# Types for the columns the pipeline uses. Other columns, such as the many extra Xeno-canto fields in the manifest,
+# are stored as strings.
+SCHEMAS = {
+    "manifest": {
+        "gen": str,
+        "sp": str,
+        "en": str,
+        "rec": str,
+        "lat": float,
+        "lon": float,
+        "file": str,
+        "lic": str,
+        "url": str,
+        "q": str,
+        "length": str,
+        "date": str,
+        "smp": float,
+    },
+    "analysis": {
+        "scientific_name": str,
+        "presence_start": float,
+        "presence_end": float,
+        "presence_score": float,
+        "start": float,
+        "end": float,
+        "floor_to_peak": float,
+        "loudness": float,
+    },
+}
+
+# Columns identifying the species of each row, used to filter by species
+SPECIES_COLUMNS = {"manifest": ["gen", "sp"], "analysis": ["scientific_name"]}
+
+
+def table_path(name: str, fmt: str = None) -> Path:
+    """Path of a table in the given storage format"""
+    return DATA_DIR / f"{name}.{fmt or STORAGE_FORMAT}"
+
+
+def stored_format(name: str) -> str | None:
+    """Format a table is stored in, preferring the configured format when both exist"""
+    for fmt in sorted(FORMATS, key=lambda f: f != STORAGE_FORMAT):
+        if table_path(name, fmt).exists():
+            return fmt
+    return None
+
+
+def table_exists(name: str) -> bool:
+    return stored_format(name) is not None
+
+
+def read_table(name: str, columns: list = None, species: list = None) -> pd.DataFrame:
+    """Read a table indexed by recording id, optionally only some columns and the rows for some species"""
+    fmt = stored_format(name)
+    if fmt is None:
+        raise FileNotFoundError(f"No stored {name} table in {DATA_DIR}")
+    path = table_path(name, fmt)
+    schema = SCHEMAS[name]
+    species_columns = SPECIES_COLUMNS[name] if species is not None else []
+    read_columns = None if columns is None else ["id"] + list(dict.fromkeys(columns + species_columns))
+
+    if fmt == "parquet":
+        # Parquet skips unread columns and row groups that cannot match the species filter
+        df = pd.read_parquet(path, columns=read_columns, filters=species_filters(name, species))
+        df = df.astype({c: t for c, t in schema.items() if c in df.columns})
+    else:
+        dtype = {"id": str} | {c: t for c, t in schema.items() if t is str}
+        df = pd.read_csv(path, usecols=read_columns, dtype=dtype)
+        df = df.assign(**{c: to_type(df[c], t) for c, t in schema.items() if t is not str and c in df.columns})
+        if species is not None:
+            df = df.loc[species_names(name, df).isin(species)]
+
+    df = df.set_index("id")
+    return df if columns is None else df[columns]
+
+
+def write_table(df: pd.DataFrame, name: str, fmt: str = None) -> Path:
+    """Write a table indexed by recording id in the configured storage format"""
+    fmt = fmt or STORAGE_FORMAT
+    path = table_path(name, fmt)
+    if fmt == "parquet":
+        df = df.reset_index()
+        schema = SCHEMAS[name]
+        for column in df.columns:
+            if column in schema:
+                df[column] = to_type(df[column], schema[column])
+            if df[column].dtype == object:
+                # Nested values from the Xeno-canto API are stored as text, as they would be in a .csv
+                df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path)
+    return path
+
+
+def to_type(values: pd.Series, dtype: type) -> pd.Series:
+    """Convert a column to its type in the schema, reading numbers that are missing or malformed as NaN"""
+    # Xeno-canto leaves the location and sample rate of some recordings empty
+    if dtype is float:
+        return pd.to_numeric(values, errors="coerce").astype(float)
+    return values.astype(dtype)
+
+
+def species_names(name: str, df: pd.DataFrame) -> pd.Series:
+    """Scientific name of the species of each row of a table"""
+    if name == "manifest":
+        return df["gen"] + " " + df["sp"]
+    return df["scientific_name"]
+
+
+def species_filters(name: str, species: list | None) -> list | None:
+    """Parquet filters, in disjunctive normal form, selecting the rows for some species"""
+    if species is None:
+        return None
+    if name == "manifest":
+        return [[("gen", "==", sn.split(" ", 1)[0]), ("sp", "==", sn.split(" ", 1)[1])] for sn in species]
+    return [("scientific_name", "in", list(species))]
+
+
+def write_app_data(app_data: dict, fmt: str = None) -> None:
+    """Write app data, which is always written as .json for the app and additionally as .parquet if configured"""
+    with open(APP_DATA_PATH, "w") as file:
+        json.dump(app_data, file,  indent=4)
+
+    if (fmt or STORAGE_FORMAT) == "parquet":
+        records = [record for recordings in app_data.values() for record in recordings]
+        pd.DataFrame(records).to_parquet(table_path("app_data", "parquet"), index=False)
+
+
+def read_app_data() -> dict:
+    """Read app data as a dictionary of recordings by species"""
+    path = table_path("app_data", "parquet")
+    if STORAGE_FORMAT == "parquet" and path.exists():
+        app_data = {}
+        for record in pd.read_parquet(path).to_dict(orient="records"):
+            app_data.setdefault(record["scientific_name"], []).append(record)
+        return app_data
+    with open(APP_DATA_PATH) as file:
+        return json.load(file)
+
+
+def export_csv(name: str) -> Path:
+    """Write a .csv copy of a table stored in any format"""
+    return write_table(read_table(name), name, fmt="csv")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "command",
+        choices=["export-csv", "convert-parquet"],
+        help="Export tables to .csv, or convert them to .parquet"
+    )
+    parser.add_argument(
+        "tables",
+        nargs="*",
+        default=list(SCHEMAS),
+        help="Tables to export or convert"
+    )
+
+    args = parser.parse_args()
+
+    for table in args.tables:
+        if args.command == "export-csv":
+            print("Wrote", export_csv(table))
+        else:
+            print("Wrote", write_table(read_table(table), table, fmt="parquet"))
@@ -0,0 +1,222 @@
+"""Load test the game by playing many sessions at once in a single process
+
+Each session plays a whole game through Streamlit's AppTest: the start page, ten questions and reviews, and the
+conclusion, optionally rating a recording on each review page. Run from the repository root:
+
+    python -m benchmarks.loadtest --sessions 50 --output load.json
+    python -m benchmarks.loadtest --sessions 50 --rate --compare load.json
+
+AppTest swaps process-wide runtime state on every run, so sessions cannot rerun on separate threads. Instead the
+sessions are all kept open and take turns, one rerun at a time in a random order, much as the reruns of a Streamlit
+server's sessions take turns holding the GIL.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from urllib.parse import unquote
+import numpy as np
+import streamlit.logger
+from streamlit.runtime import Runtime
+from streamlit.testing.v1 import AppTest, app_test
+from streamlit.testing.v1.local_script_runner import LocalScriptRunner
+
+from benchmarks.report import compare
+
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+APP_PATH = REPO_DIR / "app.py"
+STATIC_DIR = REPO_DIR / "static"
+MEDIA_ENDPOINT = "/mock/media/"
+STATIC_ENDPOINT = "/app/static/"
+PERCENTILES = [50, 90, 99]
+
+_last_run = {}  # Messages and media sent by the most recent rerun, filled in by CountingScriptRunner
+
+
+class CountingScriptRunner(LocalScriptRunner):
+    """Records the size of the messages and the URLs of the media each rerun sends to the browser"""
+
+    def forward_msgs(self) -> list:
+        msgs = super().forward_msgs()
+        _last_run["message_bytes"] = sum(msg.ByteSize() for msg in msgs)
+        _last_run["media"] = {}
+        for msg in msgs:
+            element = msg.delta.new_element
+            if element.HasField("audio"):
+                urls = [element.audio.url]
+            elif element.HasField("imgs"):
+                urls = [img.url for img in element.imgs.imgs]
+            else:
+                continue
+            for url in urls:
+                _last_run["media"][url] = media_size(url)
+        return msgs
+
+
+def media_size(url: str) -> int:
+    """Size in bytes of media served by the running test app or from the static folder"""
+    if url.startswith(MEDIA_ENDPOINT):
+        storage = Runtime.instance().media_file_mgr._storage
+        return storage.get_file(url.removeprefix(MEDIA_ENDPOINT).split(".")[0]).content_size
+    if url.startswith(STATIC_ENDPOINT):
+        return (STATIC_DIR / unquote(url.removeprefix(STATIC_ENDPOINT))).stat().st_size
+    return 0
+
+
+def rss_bytes() -> int:
+    """Resident memory of this process, or its peak where the current value is not reported"""
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+def game_steps(rate: bool, rng: np.random.Generator, n_questions: int):
+    """Interactions that play one game, each paired with the page the rerun after it should show"""
+    yield "start", lambda at: None
+    yield "question", lambda at: at.button(key="btn_start").click()
+    for i in range(n_questions):
+        yield "review", lambda at: at.button(key=f"btn_{rng.integers(3)}").click()
+        if rate:
+            yield "review", lambda at: at.radio(
+                key=f"radio_Presence_{at.session_state.recordings[0]['recording_id']}"
+            ).set_value(str(rng.choice(["Full", "Sparse", "Delayed"])))
+        yield "question" if i < n_questions - 1 else "conclusion", lambda at: at.button(key="btn_next").click()
+
+
+def run_sessions(n_sessions: int, rate: bool, seed: int = 0) -> tuple:
+    """Play a game in each of many sessions at once, returning a record of every rerun and RSS samples"""
+    import app
+
+    rng = np.random.default_rng(seed)
+    sessions = [
+        (AppTest.from_file(str(APP_PATH), default_timeout=60), game_steps(rate, rng, app.NUMBER_QUESTIONS), set())
+        for _ in range(n_sessions)
+    ]
+    reruns = []
+    rss = [rss_bytes()]
+    active = list(range(n_sessions))
+    while active:
+        for i in rng.permutation(active):
+            at, steps, referenced = sessions[i]
+            step = next(steps, None)
+            if step is None:
+                active.remove(i)
+                continue
+            page, interact = step
+            interact(at)
+
+            tic = time.perf_counter()
+            at.run()
+            latency = time.perf_counter() - tic
+
+            if at.exception:
+                raise RuntimeError(f"Session {i} failed on the {page} page: {at.exception[0].message}")
+            # The browser keeps players whose URLs are unchanged and caches static files, so only fetches new media
+            media = _last_run["media"]
+            fetched = sum(size for url, size in media.items() if url not in referenced)
+            referenced.difference_update({url for url in referenced if not url.startswith(STATIC_ENDPOINT)})
+            referenced.update(media)
+            reruns.append({
+                "session": int(i),
+                "page": page,
+                "latency_s": latency,
+                "message_bytes": _last_run["message_bytes"],
+                "media_bytes": fetched,
+            })
+        rss.append(rss_bytes())
+    return reruns, rss
+
+
+def summarize(reruns: list, rss: list, n_sessions: int, wall_s: float) -> dict:
+    """Latency percentiles by page, bytes sent and memory use for a load test"""
+    pages = {}
+    for page in ["all"] + sorted({r["page"] for r in reruns}):
+        latencies = [r["latency_s"] for r in reruns if page == "all" or r["page"] == page]
+        pages[f"rerun/{page}"] = {
+            "reruns": len(latencies),
+            "median_s": statistics.median(latencies),
+            **{f"p{p}_s": float(np.percentile(latencies, p)) for p in PERCENTILES},
+            "max_s": max(latencies),
+        }
+    message_bytes = sum(r["message_bytes"] for r in reruns)
+    media_bytes = sum(r["media_bytes"] for r in reruns)
+    return {
+        "sessions": n_sessions,
+        "reruns": len(reruns),
+        "wall_s": wall_s,
+        "reruns_per_s": len(reruns) / wall_s,
+        "message_bytes_per_game": message_bytes / n_sessions,
+        "media_bytes_per_game": media_bytes / n_sessions,
+        "rss_start_mb": rss[0] / 2 ** 20,
+        "rss_peak_mb": max(rss) / 2 ** 20,
+        "rss_per_session_mb": (max(rss) - rss[0]) / 2 ** 20 / n_sessions,
+        "results": pages,
+    }
+
+
+def main(n_sessions: int, rate: bool, static: bool, seed: int, output: str | None, baseline_path: str | None) -> None:
+    streamlit.logger.set_log_level("error")
+    app_test.LocalScriptRunner = CountingScriptRunner
+    # The app reads its arguments, and writes ratings and finds audio relative to the working directory, so run it
+    # in a scratch directory linked to the repository's data
+    sys.argv = [str(APP_PATH)] + (["--rate"] if rate else []) + (["--static"] if static else [])
+    with tempfile.TemporaryDirectory() as directory:
+        for name in ["audio", "images"]:
+            os.symlink(REPO_DIR / name, Path(directory) / name)
+        os.chdir(directory)
+        sys.path.insert(0, str(REPO_DIR))
+
+        tic = time.perf_counter()
+        reruns, rss = run_sessions(n_sessions, rate, seed=seed)
+        report = summarize(reruns, rss, n_sessions, time.perf_counter() - tic)
+        os.chdir(REPO_DIR)
+
+    print(f"{report['sessions']} sessions, {report['reruns']} reruns in {report['wall_s']:.1f} s "
+          f"({report['reruns_per_s']:.1f} reruns/s)")
+    print(f"{'page':<20}{'reruns':>8}" + "".join(f"{f'p{p} ms':>10}" for p in PERCENTILES) + f"{'max ms':>10}")
+    for name, result in report["results"].items():
+        print(f"{name:<20}{result['reruns']:>8}" + "".join(f"{result[f'p{p}_s'] * 1000:>10.1f}" for p in PERCENTILES)
+              + f"{result['max_s'] * 1000:>10.1f}")
+    print(f"Sent per game: {report['message_bytes_per_game'] / 1024:,.0f} KB of messages, "
+          f"{report['media_bytes_per_game'] / 1024:,.0f} KB of media")
+    print(f"RSS: {report['rss_start_mb']:.0f} MB at start, {report['rss_peak_mb']:.0f} MB at peak, "
+          f"{report['rss_per_session_mb']:.2f} MB per session")
+
+    if output is not None:
+        with open(output, "w") as file:
+            json.dump({"python": sys.version.split()[0], "rate": rate, "static": static, **report}, file, indent=4)
+        print("Wrote", output)
+
+    if baseline_path is not None:
+        with open(baseline_path) as file:
+            baseline = json.load(file)["results"]
+        print()
+        regressions = compare(report["results"], baseline)
+        if regressions:
+            print(len(regressions), "pages regressed")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=20, help="Number of games played at once")
+    parser.add_argument("--rate", action="store_true", help="Run the app in rating mode, rating a recording per review")
+    parser.add_argument("--static", action="store_true", help="Run the app serving media from static URLs")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the order of reruns and the answers given")
+    parser.add_argument("--output", default=None, help="Path of a .json file to save results to")
+    parser.add_argument("--compare", default=None, help="Path of saved results to compare median latency against")
+
+    args = parser.parse_args()
+
+    main(args.sessions, args.rate, args.static, args.seed, args.output, args.compare)
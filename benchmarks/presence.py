@@ -0,0 +1,102 @@
+"""Benchmark presence scoring against the original loop-based implementation
+
+Run from the repository root:
+
+    python -m benchmarks.presence --seconds 300 --overlap 1
+"""
+import argparse
+import timeit
+import numpy as np
+import pandas as pd
+
+from audio.analyze import WEIGHTS, score_presence
+
+
+TARGET = "Sayornis nigricans"
+OTHERS = ["Passer domesticus", "Junco hyemalis", "Melozone crissalis"]
+
+
+def synthetic_detections(seconds: float, overlap: float, seed: int = 0, missing: float = .1) -> list:
+    """Make BirdNET-style detections for a recording, leaving some frames without any detection"""
+    rng = np.random.default_rng(seed)
+    increment = 3 if overlap == 0 else overlap
+    detections = []
+    for start in np.arange(0, seconds - 3 + increment, increment):
+        if start > 0 and rng.random() < missing:
+            continue
+        for name in rng.choice([TARGET] + OTHERS, size=rng.integers(1, 4), replace=False):
+            detections.append({
+                "common_name": name,
+                "scientific_name": name,
+                "start_time": float(start),
+                "end_time": float(start + 3),
+                "confidence": float(rng.random()),
+            })
+    return detections
+
+
+def legacy_score_presence(detections: list, scientific_name: str, weights: np.ndarray, overlap: float) -> tuple:
+    """The original groupby/apply and per-frame loop implementation, kept as a reference"""
+    detections = pd.DataFrame(detections)
+    grouper = detections.groupby("start_time")
+    on_target = grouper.apply(
+        lambda grp: sum(grp['confidence'] * pd.Series(grp['scientific_name'] == scientific_name).astype(float)),
+        include_groups=False
+    )
+    off_target = grouper.apply(
+        lambda grp: sum(grp['confidence'] * pd.Series(grp['scientific_name'] != scientific_name).astype(float)),
+        include_groups=False
+    )
+    aggregate = pd.DataFrame({"on_target": on_target, "off_target": off_target})
+    aggregate['delta'] = aggregate["on_target"] - aggregate["off_target"]
+
+    last_start = detections["start_time"].iloc[-1]
+    increment = 3 if overlap == 0 else overlap
+    expected_starts = np.arange(0, last_start + increment, increment)
+    aggregate = aggregate.reindex(expected_starts).fillna(0)
+
+    n_frames = len(weights)
+    score_holder = [np.nan] * len(aggregate)
+    for i in range(len(aggregate) - n_frames + 1):
+        subset = aggregate.iloc[i:i + n_frames]
+        score_holder[i] = np.average(subset["on_target"] - subset["off_target"], weights=weights)
+
+    aggregate['score'] = score_holder
+    best_start_frame = aggregate['score'].argmax()
+    best_end_frame = best_start_frame + n_frames - 1
+    return aggregate.index[best_start_frame], aggregate.index[best_end_frame] + 3, aggregate
+
+
+def check_agreement(n_recordings: int, seconds: float, overlap: float) -> None:
+    """Confirm both implementations choose the same segment for a range of recordings and weights"""
+    for weights in [WEIGHTS, np.ones(1), np.linspace(1, 2, 7)]:
+        for seed in range(n_recordings):
+            detections = synthetic_detections(seconds, overlap, seed=seed)
+            expected = legacy_score_presence(detections, TARGET, weights, overlap)
+            actual = score_presence(detections, TARGET, weights, overlap)
+            assert expected[:2] == actual[:2], f"Segments differ for seed {seed}: {expected[:2]} vs {actual[:2]}"
+            assert np.allclose(expected[2]['score'], actual[2]['score'], equal_nan=True)
+
+
+def main(seconds: float, overlap: float, repeat: int) -> None:
+    check_agreement(n_recordings=20, seconds=seconds, overlap=overlap)
+    print("Legacy and vectorized scoring agree on presence_start and presence_end")
+
+    detections = synthetic_detections(seconds, overlap)
+    legacy = min(timeit.repeat(lambda: legacy_score_presence(detections, TARGET, WEIGHTS, overlap), number=1, repeat=repeat))
+    vectorized = min(timeit.repeat(lambda: score_presence(detections, TARGET, WEIGHTS, overlap), number=1, repeat=repeat))
+    print(f"{seconds} s recording, overlap={overlap}, {len(detections)} detections")
+    print(f"Legacy:     {legacy * 1000:.2f} ms")
+    print(f"Vectorized: {vectorized * 1000:.2f} ms")
+    print(f"Speedup:    {legacy / vectorized:.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=300, help="Length of the synthetic recording")
+    parser.add_argument("--overlap", type=float, default=1, help="BirdNET overlap setting")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timing repetitions")
+
+    args = parser.parse_args()
+
+    main(args.seconds, args.overlap, args.repeat)
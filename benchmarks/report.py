@@ -0,0 +1,24 @@
+"""Compare benchmark results with a saved baseline
+
+Kept free of the audio and app dependencies so that every benchmark can report regressions without importing them.
+"""
+
+
+TOLERANCE = 0.1  # Relative slowdown in median latency reported as a regression
+
+
+def compare(results: dict, baseline: dict, tolerance: float = TOLERANCE) -> list:
+    """Print the change in median latency for cases in both runs, returning the names of regressed cases"""
+    regressions = []
+    print(f"{'case':<40}{'before ms':>12}{'after ms':>12}{'change':>10}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]["median_s"], result["median_s"]
+        change = after / before - 1
+        flag = ""
+        if change > tolerance:
+            regressions.append(name)
+            flag = "  regression"
+        print(f"{name:<40}{before * 1000:>12.2f}{after * 1000:>12.2f}{change:>+10.1%}{flag}")
+    return regressions
@@ -0,0 +1,107 @@
+"""Benchmark the app's cold start as the catalogue grows
+
+Each run starts a fresh Python process in a directory holding a synthetic catalogue, then times importing Streamlit,
+rendering the start page (time to first paint) and starting a game. Run from the repository root:
+
+    python -m benchmarks.startup --output startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+APP_PATH = REPO_DIR / "app.py"
+SIZES = [100, 1_000, 5_000]
+STEPS = ["import_s", "first_paint_s", "start_game_s"]
+
+
+def measure_startup(snapshot: bool) -> dict:
+    """Time a cold start of the app on the catalogue in the working directory, in this fresh process"""
+    tic = time.perf_counter()
+    import streamlit.logger
+    streamlit.logger.set_log_level("error")
+    from streamlit.testing.v1 import AppTest
+    from phoebe import data
+    imported = time.perf_counter()
+
+    # Point the catalogue at the synthetic data; the app finds audio relative to the working directory
+    directory = Path().resolve()
+    data.APP_DATA_PATH = directory / "audio" / "data" / "app_data.json"
+    data.BIRD_IMAGE_DATA_PATH = directory / "images" / "data" / "bird_images.jsonl"
+    data.SNAPSHOT_PATH = directory / "audio" / "data" / "catalogue.pickle"
+    if snapshot:
+        data.write_snapshot()
+        imported = time.perf_counter()
+
+    at = AppTest.from_file(str(APP_PATH), default_timeout=600).run()
+    painted = time.perf_counter()
+    loaded_before_paint = data._catalogue is not None
+
+    at.button(key="btn_start").click().run()
+    started = time.perf_counter()
+    if at.exception or len(at.get("audio")) != 3:
+        raise RuntimeError(f"Starting a game failed: {at.exception}")
+
+    return {
+        "import_s": imported - tic,
+        "first_paint_s": painted - imported,
+        "start_game_s": started - painted,
+        "catalogue_loaded_before_paint": loaded_before_paint,
+    }
+
+
+def run_cold(directory: Path, snapshot: bool) -> dict:
+    """Measure a cold start in a new process"""
+    command = [sys.executable, "-m", "benchmarks.startup", "--child"] + (["--snapshot"] if snapshot else [])
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [str(REPO_DIR), os.environ.get("PYTHONPATH")]))}
+    result = subprocess.run(command, cwd=directory, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def main(sizes: list, repeat: int, output: str | None) -> None:
+    # Imported here rather than at the top so the measured processes import only what the app does
+    from benchmarks.fixtures import make_catalogue
+
+    results = {}
+    print(f"{'case':<28}" + "".join(f"{step.removesuffix('_s') + ' ms':>18}" for step in STEPS))
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            make_catalogue(Path(directory), n)
+            for snapshot in [False, True]:
+                name = f"{'snapshot' if snapshot else 'json'}/{n}"
+                runs = [run_cold(Path(directory), snapshot) for _ in range(repeat)]
+                result = {step: statistics.median(run[step] for run in runs) for step in STEPS}
+                result["catalogue_loaded_before_paint"] = any(run["catalogue_loaded_before_paint"] for run in runs)
+                results[name] = result
+                flag = "  catalogue loaded before first paint" if result["catalogue_loaded_before_paint"] else ""
+                print(f"{name:<28}" + "".join(f"{result[step] * 1000:>18.1f}" for step in STEPS) + flag)
+
+    if output is not None:
+        with open(output, "w") as file:
+            json.dump({"python": sys.version.split()[0], "repeat": repeat, "results": results}, file, indent=4)
+        print("Wrote", output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="Numbers of recordings in the catalogue")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of cold starts for each case")
+    parser.add_argument("--output", default=None, help="Path of a .json file to save results to")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--snapshot", action="store_true", help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure_startup(args.snapshot)))
+    else:
+        main(args.sizes, args.repeat, args.output)
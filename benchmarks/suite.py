@@ -0,0 +1,222 @@
+"""Benchmark the audio pipeline and game hot paths on synthetic fixtures
+
+Run from the repository root, saving results to compare later runs against:
+
+    python -m benchmarks.suite --output before.json
+    python -m benchmarks.suite --output after.json --compare before.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+import numpy as np
+import streamlit.logger
+
+from audio.analyze import BIRDNET_RATE, CLIP_METRICS, METRICS_RATE, MIN_CONF, OVERLAP, WEIGHTS, Features, \
+    analyze_presence, find_onset, floor_to_peak
+from audio.download import score_and_rank_recordings
+from audio.embeddings import build_index
+from audio.process import clip_mp3
+from benchmarks.fixtures import FIXTURES, TARGET, StubAnalyzer, make_manifest, make_mp3
+from benchmarks.report import TOLERANCE, compare
+
+
+DURATIONS = [30, 300]
+MANIFEST_ROWS = [1_000, 100_000]
+QUESTIONS = 1_000
+SIMILARITY_RECORDINGS = [1_000, 20_000]  # Recordings in synthetic catalogues of 10 per species
+EMBEDDING_DIMENSION = 1024
+
+
+def audio_cases(durations: list) -> list:
+    """Cases for the analysis functions, for each kind of synthetic audio and duration"""
+    cases = []
+    analyzer = StubAnalyzer()
+    for kind, make in FIXTURES.items():
+        for seconds in durations:
+            birdnet_data = make(seconds, BIRDNET_RATE)
+            metrics_data = make(seconds, METRICS_RATE)
+            cases += [
+                (f"analyze_presence/{kind}/{seconds}s", seconds, "audio s",
+                 lambda d=birdnet_data: quietly(analyze_presence, analyzer, d, BIRDNET_RATE, TARGET, WEIGHTS,
+                                                overlap=OVERLAP, min_conf=MIN_CONF)),
+                (f"find_onset/{kind}/{seconds}s", seconds, "audio s",
+                 lambda d=metrics_data, s=seconds: find_onset(Features(d, METRICS_RATE), start=s / 2)),
+                (f"floor_to_peak/{kind}/{seconds}s", seconds, "audio s",
+                 lambda d=metrics_data, s=seconds: floor_to_peak(Features(d, METRICS_RATE), 0, s)),
+                (f"clip_metrics/{kind}/{seconds}s", seconds, "audio s",
+                 lambda d=metrics_data, s=seconds: clip_metrics(d, s)),
+            ]
+    return cases
+
+
+def clip_metrics(data: np.ndarray, seconds: float) -> dict:
+    """Find an onset and every metric of a six second clip from it, sharing one set of features as the analysis does"""
+    features = Features(data, METRICS_RATE)
+    onset = find_onset(features, start=seconds / 2)
+    return {name: metric(features, onset, onset + 6) for name, metric in CLIP_METRICS.items()}
+
+
+def clip_cases(durations: list, directory: Path) -> list:
+    """Cases for clipping a six second span from the middle of MP3 files"""
+    cases = []
+    for seconds in durations:
+        path = make_mp3(directory / f"{seconds}.mp3", seconds)
+        cases.append((f"clip_mp3/{seconds}s", 1, "clips",
+                      lambda p=path, s=seconds: clip_mp3(p, directory / "clip.mp3", s / 2, s / 2 + 6)))
+    return cases
+
+
+def ranking_cases(sizes: list) -> list:
+    """Cases for scoring and ranking manifests of different sizes"""
+    return [
+        (f"score_and_rank_recordings/{n}", n, "rows", lambda m=make_manifest(n): score_and_rank_recordings(m))
+        for n in sizes
+    ]
+
+
+def question_cases(n: int) -> list:
+    """Cases for drawing questions from the app data, one at a time as the game does and in bulk"""
+    # Outside of `streamlit run`, Streamlit warns on every use of st.session_state and of the st.cache_resource
+    # loaders that there is no script run context
+    streamlit.logger.set_log_level("error")
+    import app
+
+    def generate_questions():
+        for i in range(n):
+            if i % app.NUMBER_QUESTIONS == 0:
+                app.st.session_state.pop("round", None)
+            app.st.session_state.counter = i % app.NUMBER_QUESTIONS + 1
+            app.generate_question()
+
+    n_rounds = n // app.NUMBER_QUESTIONS
+    index = app.load_question_index()
+    records = app.catalogue.load().records
+    embeddings = np.random.default_rng(0).standard_normal((len(index.recordings), EMBEDDING_DIMENSION))
+    hard_index = app.QuestionIndex(records, similarity=build_index(records, embeddings))
+    return [
+        (f"generate_question/{n}", n, "questions", generate_questions),
+        (f"sample_rounds/{n_rounds}", n_rounds, "rounds", lambda: index.sample_rounds(n_rounds, seed=0)),
+        (f"sample_rounds/hard/{n_rounds}", n_rounds, "rounds",
+         lambda: hard_index.sample_rounds(n_rounds, seed=0, hard=True)),
+    ]
+
+
+def similarity_cases(sizes: list) -> list:
+    """Cases for building the similarity index, and drawing hard questions from it, for catalogues of different sizes"""
+    import app
+
+    cases = []
+    for n in sizes:
+        records = {
+            f"species {s}": [{"recording_id": f"{s}-{i}"} for i in range(10)] for s in range(n // 10)
+        }
+        embeddings = np.random.default_rng(0).standard_normal((n, EMBEDDING_DIMENSION)).astype(np.float32)
+        index = app.QuestionIndex(records, similarity=build_index(records, embeddings))
+        cases += [
+            (f"build_index/{n}", n, "recordings", lambda r=records, e=embeddings: build_index(r, e)),
+            (f"sample_rounds/hard/catalogue/{n}", 1, "rounds",
+             lambda index=index: index.sample_rounds(1, seed=0, hard=True)),
+        ]
+    return cases
+
+
+def quietly(fn, *args, **kwargs):
+    """Call a function, discarding what it prints"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        return fn(*args, **kwargs)
+
+
+def measure(fn, repeat: int) -> dict:
+    """Trace memory allocations in one call to find the peak, then time repeated calls"""
+    # The traced call also warms up caches and lazy imports before timing
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    times = []
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - tic)
+
+    return {
+        "median_s": statistics.median(times),
+        "min_s": min(times),
+        "max_s": max(times),
+        "peak_mb": peak / 2 ** 20,
+    }
+
+
+def run(cases: list, repeat: int, only: str | None = None) -> dict:
+    """Measure each case, printing latency, throughput and peak memory as it goes"""
+    results = {}
+    print(f"{'case':<40}{'median ms':>12}{'throughput':>24}{'peak MB':>10}")
+    for name, amount, unit, fn in cases:
+        if only is not None and only not in name:
+            continue
+        result = measure(fn, repeat)
+        result["throughput"] = amount / result["median_s"]
+        result["throughput_unit"] = f"{unit}/s"
+        results[name] = result
+        throughput = f"{result['throughput']:,.1f} {result['throughput_unit']}"
+        print(f"{name:<40}{result['median_s'] * 1000:>12.2f}{throughput:>24}{result['peak_mb']:>10.1f}")
+    return results
+
+
+def main(repeat: int, durations: list, output: str | None, baseline_path: str | None, only: str | None) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        cases = (
+            audio_cases(durations)
+            + clip_cases(durations, Path(directory))
+            + ranking_cases(MANIFEST_ROWS)
+            + question_cases(QUESTIONS)
+            + similarity_cases(SIMILARITY_RECORDINGS)
+        )
+        results = run(cases, repeat=repeat, only=only)
+
+    if output is not None:
+        report = {
+            "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "numpy": np.__version__,
+            "repeat": repeat,
+            "results": results,
+        }
+        with open(output, "w") as file:
+            json.dump(report, file, indent=4)
+        print("Wrote", output)
+
+    if baseline_path is not None:
+        with open(baseline_path) as file:
+            baseline = json.load(file)["results"]
+        print()
+        regressions = compare(results, baseline)
+        if regressions:
+            print(len(regressions), "cases regressed by more than", f"{TOLERANCE:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timed calls for each case")
+    parser.add_argument("--durations", type=int, nargs="+", default=DURATIONS,
+                        help="Seconds of synthetic audio (30 to 300)")
+    parser.add_argument("--output", default=None, help="Path of a .json file to save results to")
+    parser.add_argument("--compare", default=None, help="Path of saved results to compare against")
+    parser.add_argument("--only", default=None, help="Run only cases whose name contains this text")
+
+    args = parser.parse_args()
+
+    main(args.repeat, args.durations, args.output, args.compare, args.only)
@@ -1 +1,8 @@
-from .data import BIRDS, RECORDS, ID_LOOKUP
\ No newline at end of file
+from . import data
+
+
+def __getattr__(name: str):
+    # The catalogue is loaded the first time BIRDS, RECORDS or ID_LOOKUP is used rather than on import
+    if name in ("BIRDS", "RECORDS", "ID_LOOKUP"):
+        return getattr(data, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
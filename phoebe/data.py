@@ -0,0 +1,122 @@
+"""Catalogue of the species, recordings and bird images used by the game, loaded on first access
+
+`BIRDS` maps each species to its image metadata, `RECORDS` maps each species to its recordings and `ID_LOOKUP` maps
+each recording id to its recording. The catalogue is read from the snapshot written by audio/process.py when it is
+newer than the app data and image metadata, and otherwise from those files.
+"""
+import json
+import pickle
+import sys
+import threading
+from pathlib import Path
+
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+APP_DATA_PATH = BASE_DIR / "audio" / "data" / "app_data.json"
+BIRD_IMAGE_DATA_PATH = BASE_DIR / "images" / "data" / "bird_images.jsonl"
+SNAPSHOT_PATH = BASE_DIR / "audio" / "data" / "catalogue.pickle"
+SNAPSHOT_VERSION = 1
+
+_catalogue = None
+_lock = threading.Lock()
+
+
+class Catalogue:
+    """Recordings and bird images indexed by species and by recording id"""
+    __slots__ = ("records", "birds", "id_lookup")
+
+    def __init__(self, records: dict, birds: dict):
+        self.records = records
+        self.birds = birds
+        self.id_lookup = {record["recording_id"]: record for recordings in records.values() for record in recordings}
+
+    @property
+    def species_names(self) -> list:
+        return list(self.records)
+
+    def recording(self, recording_id: str) -> dict:
+        """The recording with the given id"""
+        return self.id_lookup[recording_id]
+
+    def recordings(self, scientific_name: str) -> list:
+        """The recordings of a species, or an empty list for a species with none"""
+        return self.records.get(scientific_name, [])
+
+
+def load() -> Catalogue:
+    """The catalogue, read once per process"""
+    global _catalogue
+    if _catalogue is None:
+        with _lock:
+            if _catalogue is None:
+                _catalogue = read_snapshot() if snapshot_is_current() else read_sources()
+    return _catalogue
+
+
+def read_sources() -> Catalogue:
+    """Read the catalogue from the app data and image metadata"""
+    with open(APP_DATA_PATH) as file:
+        records = json.load(file)
+    with open(BIRD_IMAGE_DATA_PATH) as file:
+        images = [json.loads(line) for line in file]
+    return Catalogue(records, {image["scientific_name"]: image for image in images})
+
+
+def snapshot_is_current() -> bool:
+    """Whether the snapshot exists and was written after the files it was built from last changed"""
+    if not SNAPSHOT_PATH.exists():
+        return False
+    modified = SNAPSHOT_PATH.stat().st_mtime
+    return all(path.stat().st_mtime <= modified for path in [APP_DATA_PATH, BIRD_IMAGE_DATA_PATH])
+
+
+def write_snapshot(path: Path = None) -> Path:
+    """Write the catalogue read from the app data and image metadata as a snapshot"""
+    path = path or SNAPSHOT_PATH
+    # Recordings are stored as rows of a table, and repeated strings such as species names, authors and licenses are
+    # interned so that pickle stores each once and loading shares a single copy of each between recordings
+    catalogue = read_sources()
+    recordings = [record for records in catalogue.records.values() for record in records]
+    fields = list(dict.fromkeys(field for record in recordings for field in record))
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "species": catalogue.species_names,
+        "counts": [len(records) for records in catalogue.records.values()],
+        "fields": fields,
+        "rows": [tuple(_intern(record.get(field)) for field in fields) for record in recordings],
+        "birds": catalogue.birds,
+    }
+    temporary_path = path.with_suffix(".tmp")
+    with open(temporary_path, "wb") as file:
+        pickle.dump(snapshot, file, protocol=pickle.HIGHEST_PROTOCOL)
+    temporary_path.replace(path)
+    return path
+
+
+def read_snapshot(path: Path = None) -> Catalogue:
+    """Read the catalogue from a snapshot, falling back to the source files for a snapshot of another version"""
+    # Snapshots are only ever written locally by audio/process.py, so are trusted like the rest of the data
+    with open(path or SNAPSHOT_PATH, "rb") as file:
+        snapshot = pickle.load(file)
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        return read_sources()
+
+    fields = snapshot["fields"]
+    rows = iter(snapshot["rows"])
+    records = {
+        scientific_name: [dict(zip(fields, next(rows))) for _ in range(count)]
+        for scientific_name, count in zip(snapshot["species"], snapshot["counts"])
+    }
+    return Catalogue(records, snapshot["birds"])
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def __getattr__(name: str):
+    # Module attributes that load the catalogue the first time one is used
+    attributes = {"BIRDS": "birds", "RECORDS": "records", "ID_LOOKUP": "id_lookup"}
+    if name not in attributes:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(load(), attributes[name])
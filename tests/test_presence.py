@@ -0,0 +1,64 @@
+"""Check that the vectorized presence scoring chooses the same segment as the original implementation
+
+Run from the repository root with `python -m pytest tests`.
+"""
+import numpy as np
+import pytest
+
+from audio.analyze import WEIGHTS, score_presence
+from benchmarks.presence import OTHERS, TARGET, legacy_score_presence, synthetic_detections
+
+
+def detection(name: str, start: float, confidence: float) -> dict:
+    return {
+        "common_name": name,
+        "scientific_name": name,
+        "start_time": float(start),
+        "end_time": float(start + 3),
+        "confidence": confidence,
+    }
+
+
+def assert_agree(detections: list, weights: np.ndarray, overlap: float) -> None:
+    """Check that both implementations choose the same segment and scores, or fail with the same type of error"""
+    try:
+        expected = legacy_score_presence(detections, TARGET, weights, overlap)
+    except Exception as error:
+        with pytest.raises(type(error)):
+            score_presence(detections, TARGET, weights, overlap)
+        return
+    actual = score_presence(detections, TARGET, weights, overlap)
+    assert expected[:2] == actual[:2]
+    assert np.allclose(expected[2]["score"], actual[2]["score"], equal_nan=True)
+
+
+@pytest.mark.parametrize("weights", [WEIGHTS, np.ones(1), np.linspace(1, 2, 7)])
+@pytest.mark.parametrize("overlap", [0, 1, 2])
+@pytest.mark.parametrize("seed", range(5))
+def test_synthetic_recordings(weights, overlap, seed):
+    assert_agree(synthetic_detections(60, overlap, seed=seed), weights, overlap)
+
+
+def test_no_detections():
+    assert_agree([], WEIGHTS, 1)
+
+
+@pytest.mark.parametrize("weights", [WEIGHTS, np.ones(1)])
+def test_single_window(weights):
+    assert_agree([detection(TARGET, 0, .8), detection(OTHERS[0], 0, .3)], weights, 1)
+
+
+def test_only_off_target_detections():
+    assert_agree([detection(OTHERS[0], start, .5) for start in range(10)], WEIGHTS, 1)
+
+
+@pytest.mark.parametrize("weights", [WEIGHTS, np.ones(1), np.ones(3)])
+def test_ties_choose_the_first_window(weights):
+    detections = [detection(TARGET, start, .5) for start in range(12)]
+    assert_agree(detections, weights, 1)
+    assert score_presence(detections, TARGET, weights, 1)[0] == 0
+
+
+def test_missing_frames():
+    detections = [detection(TARGET, start, .9) for start in [0, 1, 5, 6, 7, 8, 12]]
+    assert_agree(detections, WEIGHTS, 1)